@@ -0,0 +1,594 @@
+# ============================================
+# Follow-up generator benchmarks
+#
+#   python bench.py prefix [--models Qwen/Qwen2.5-0.5B-Instruct Qwen/Qwen2.5-1.5B-Instruct]
+#       prefill time per request with vs without the shared system-prompt cache
+#   python bench.py cpu-profiles [--adapter-dir followuplora --limit 40 --threads 8]
+#       fp32 vs bf16 vs int8 on held-out conversation_data.csv rows:
+#       latency, speedup, token-F1 vs the doctor and agreement with fp32
+#   python bench.py early-stop [--adapter-dir followuplora --repeats 5]
+#       decode steps and latency saved per request by QuestionStop on the demo histories
+#   python bench.py latency [--adapter-dir followuplora --limit 200 --concurrency 1 4 8 --batch-sizes 1 4 8]
+#       conversation_data.csv turns replayed through engine.generate (test.py's gen_one_question)
+#       or the micro-batcher: p50/p95/p99 latency, TTFT (streaming), tokens/sec, questions/sec
+#   python bench.py speculative [--adapter-dir followuplora --draft-model Qwen/Qwen2.5-0.5B-Instruct]
+#       draft-model speculative decoding vs plain decoding on held-out rows (greedy):
+#       acceptance rate, tokens per target forward, latency speedup, output agreement
+#   python bench.py semantic-cache [--adapter-dir followuplora --thresholds 0.95 0.97 0.98 0.99]
+#       similarity-tier false hits on conversation_data.csv first turns: each first turn looks
+#       up all the others; a hit whose doctor question differs counts as false (hidden vs token)
+#   python bench.py startup [--adapter-dir followuplora --repeats 3 --baseline <git ref>]
+#       import-to-first-question in fresh processes through get_engine (+ mmap weights),
+#       training.generateNextQuestion and test.gen_one_question, for this tree and for a
+#       git worktree of --baseline (e.g. the original tree: training.py + test.py only)
+#   python bench.py ddp-scaling [--csv conversation_data.csv --procs 1 2 4 8 --steps 20]
+#       LoRA SFT throughput on CPU with 1/2/4/8 DDP (gloo) processes: tokens/sec, speedup, efficiency
+#
+# Every subcommand prints a JSON report (and writes it with --out).
+# ============================================
+
+import argparse, json, os, statistics, subprocess, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
+
+import torch
+from followup.engine import FollowUpEngine, CPU_PROFILES, normalize_question
+from evaluation import load_heldout_examples, token_f1
+
+DEMO_HISTORIES: List[List[Dict[str,str]]] = [
+    [{"role":"patient","content":"I’ve had a dull headache for 3 days and mild fever."}],
+    [{"role":"patient","content":"I've had this pain in my chest for just over a week and it's hard to breathe."}],
+    [
+        {"role":"patient","content":"My stomach has been hurting since yesterday."},
+        {"role":"assistant","content":"Where exactly is the pain?"},
+        {"role":"patient","content":"Lower right side, and it gets worse when I walk."},
+    ],
+]
+
+SIZES = ["Qwen/Qwen2.5-0.5B-Instruct", "Qwen/Qwen2.5-1.5B-Instruct"]
+
+def _ms(samples: List[float]) -> float:
+    return round(statistics.mean(samples) * 1000.0, 2)
+
+def _pct_ms(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))] * 1000.0, 2)
+
+def _latency_stats(prefix: str, samples: List[float]) -> Dict:
+    stats = {f"{prefix}_ms_p{q}": _pct_ms(samples, q) for q in (50, 95, 99)}
+    stats[f"{prefix}_ms_mean"] = _ms(samples)
+    return stats
+
+@torch.inference_mode()
+def bench_prefix(models: List[str], repeats: int) -> Dict:
+    report = {}
+    for name in models:
+        engine = FollowUpEngine(None, base_model=name)
+        cold, warm = [], []
+        for history in DEMO_HISTORIES:
+            ids = engine._to_device(engine.tok([engine.build_prompt(history)], return_tensors="pt"))["input_ids"]
+            for use_prefix, bucket in ((False, cold), (True, warm)):
+                engine.use_sys_prefix = use_prefix
+                engine._prefill(ids)   # warm-up (allocator, kernels)
+                for _ in range(repeats):
+                    t0 = time.perf_counter()
+                    engine._prefill(ids)
+                    bucket.append(time.perf_counter() - t0)
+        report[name] = {
+            "sys_prefix_tokens": len(engine.sys_prefix[0]),
+            "prefill_ms_full": _ms(cold),
+            "prefill_ms_from_sys_prefix": _ms(warm),
+            "saved_ms_per_request": round(_ms(cold) - _ms(warm), 2),
+            "device": "cuda" if engine.has_gpu else "cpu",
+        }
+        del engine
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    return report
+
+@torch.inference_mode()
+def bench_cpu_profiles(adapter_dir: str, csv_path: str, limit: int, threads: int, profiles: List[str]) -> Dict:
+    examples = load_heldout_examples(csv_path, limit=limit)
+    outputs: Dict[str, List[str]] = {}
+    report = {"examples": len(examples), "threads": threads}
+    for profile in profiles:
+        engine = FollowUpEngine(adapter_dir, cpu_profile=profile, num_threads=threads)
+        engine.generate(examples[0]["history"], temperature=0)   # warm-up
+        lat, preds = [], []
+        for ex in examples:
+            t0 = time.perf_counter()
+            # greedy: differences come from the numerics, not from sampling
+            preds.append(engine.generate(ex["history"], temperature=0))
+            lat.append(time.perf_counter() - t0)
+        outputs[profile] = preds
+        report[profile] = {
+            "effective_profile": engine.cpu_profile,
+            "load_s": round(engine.load_seconds, 2),
+            "latency_ms_mean": _ms(lat),
+            "latency_ms_p50": round(sorted(lat)[len(lat) // 2] * 1000.0, 2),
+            "f1_vs_reference": round(statistics.mean(token_f1(p, ex["reference"]) for p, ex in zip(preds, examples)), 4),
+        }
+        del engine
+
+    base = report.get("fp32")
+    for profile in profiles:
+        if profile == "fp32" or base is None:
+            continue
+        report[profile]["speedup_vs_fp32"] = round(base["latency_ms_mean"] / report[profile]["latency_ms_mean"], 2)
+        report[profile]["agreement_f1_vs_fp32"] = round(
+            statistics.mean(token_f1(a, b) for a, b in zip(outputs[profile], outputs["fp32"])), 4
+        )
+        report[profile]["exact_match_vs_fp32"] = round(
+            statistics.mean(float(a == b) for a, b in zip(outputs[profile], outputs["fp32"])), 4
+        )
+    return report
+
+@torch.inference_mode()
+def bench_early_stop(adapter_dir: str, repeats: int, max_new_tokens: int) -> Dict:
+    engine = FollowUpEngine(adapter_dir)
+    engine.generate(DEMO_HISTORIES[0])   # warm-up
+    runs = {}
+    for early in (False, True):
+        engine.early_stop = early
+        lat, toks = [], []
+        for i, history in enumerate(DEMO_HISTORIES):
+            for r in range(repeats):
+                torch.manual_seed(1000 * i + r)   # same samples in both modes
+                t0 = time.perf_counter()
+                engine.generate(history, max_new_tokens=max_new_tokens)
+                lat.append(time.perf_counter() - t0)
+                toks.append(engine.last_new_tokens)
+        runs[early] = (lat, toks)
+
+    (lat_off, tok_off), (lat_on, tok_on) = runs[False], runs[True]
+    return {
+        "requests": len(lat_on),
+        "max_new_tokens": max_new_tokens,
+        "tokens_per_request_full": round(statistics.mean(tok_off), 2),
+        "tokens_per_request_early_stop": round(statistics.mean(tok_on), 2),
+        "tokens_saved_per_request": round(statistics.mean(tok_off) - statistics.mean(tok_on), 2),
+        "latency_ms_full": _ms(lat_off),
+        "latency_ms_early_stop": _ms(lat_on),
+        "latency_saved_ms_per_request": round(_ms(lat_off) - _ms(lat_on), 2),
+    }
+
+def bench_latency(adapter_dir: str, csv_path: str, limit: int, concurrency: List[int], batch_sizes: List[int],
+                  max_new_tokens: int, temperature: float, max_wait_ms: float,
+                  cpu_profile: str, threads: Optional[int]) -> Dict:
+    from followup.batching import MicroBatchScheduler
+    # frac=1.0: every conversation, one request per doctor question, history as it stood then
+    examples = load_heldout_examples(csv_path, frac=1.0, limit=limit)
+    engine = FollowUpEngine(adapter_dir, cpu_profile=cpu_profile, num_threads=threads)
+    engine.generate(examples[0]["history"], temperature=temperature)   # warm-up
+    n_tokens = lambda q: len(engine.tok(q, add_special_tokens=False)["input_ids"])
+    gen = dict(max_new_tokens=max_new_tokens, temperature=temperature)
+
+    def replay(c: int, call) -> Dict:
+        """Every example through call(ex, t0) -> (question, ttft_s or None) on c client threads."""
+        for ex in examples:
+            engine.end_session(ex["id"])   # every run starts without session KV
+        torch.manual_seed(0)
+
+        def one(ex):
+            t0 = time.perf_counter()
+            question, ttft = call(ex, t0)
+            return question, ttft, time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=c) as pool:
+            results = list(pool.map(one, examples))
+        wall = time.perf_counter() - t0
+        run = {
+            "requests": len(results),
+            "wall_s": round(wall, 2),
+            "questions_per_sec": round(len(results) / wall, 3),
+            "tokens_per_sec": round(sum(n_tokens(q) for q, _, _ in results) / wall, 1),
+        }
+        run.update(_latency_stats("latency", [lat for _, _, lat in results]))
+        if results[0][1] is not None:
+            run.update(_latency_stats("ttft", [ttft for _, ttft, _ in results]))
+        return run
+
+    def via_generate(ex, t0):
+        return engine.generate(ex["history"], session_id=ex["id"], **gen), None
+
+    def via_stream(ex, t0):
+        ttft, parts = None, []
+        for delta in engine.stream(ex["history"], session_id=ex["id"], **gen):
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            parts.append(delta)
+        return "".join(parts), ttft if ttft is not None else time.perf_counter() - t0
+
+    report = {"adapter_dir": adapter_dir, "requests": len(examples), "cpu_profile": engine.cpu_profile,
+              "device": "cuda" if engine.has_gpu else "cpu", "max_new_tokens": max_new_tokens,
+              "temperature": temperature, "runs": {}}
+    for bs in batch_sizes:
+        scheduler = None
+        if bs > 1:
+            scheduler = MicroBatchScheduler(engine, max_batch_size=bs, max_wait_ms=max_wait_ms, **gen)
+            scheduler.start_in_thread()
+        for c in concurrency:
+            if scheduler is None:
+                run = replay(c, via_generate)
+                streamed = replay(c, via_stream)
+                run.update({k: v for k, v in streamed.items() if k.startswith("ttft_")})
+                run["stream_latency_ms_p50"] = streamed["latency_ms_p50"]
+            else:
+                # whole questions come back per batch: no separate TTFT
+                run = replay(c, lambda ex, t0: (scheduler.submit_threadsafe(ex["history"]), None))
+                run["batching"] = scheduler.metrics()
+            report["runs"][f"batch{bs}_conc{c}"] = run
+            print(f"[latency] batch={bs} concurrency={c}: p50 {run['latency_ms_p50']} ms, "
+                  f"{run['questions_per_sec']} q/s")
+    return report
+
+@torch.inference_mode()
+def bench_speculative(adapter_dir: str, draft_model: Optional[str], draft_adapter_dir: Optional[str],
+                      csv_path: str, limit: int, max_new_tokens: int, draft_tokens: int) -> Dict:
+    examples = load_heldout_examples(csv_path, limit=limit)
+    engine = FollowUpEngine(adapter_dir, draft_model=draft_model, draft_adapter_dir=draft_adapter_dir,
+                            draft_tokens=draft_tokens)
+    draft = engine.draft
+
+    # Forward calls of the underlying HF models (PeftModel.generate bypasses PeftModel.forward)
+    calls = {"target": 0, "draft": 0}
+    def _core(m):
+        return m.get_base_model() if hasattr(m, "get_base_model") else m
+    def _counter(name):
+        def hook(module, args, output):
+            calls[name] += 1
+        return hook
+    hooks = [_core(engine.model).register_forward_hook(_counter("target")),
+             _core(draft).register_forward_hook(_counter("draft"))]
+
+    def run(history, speculative: bool):
+        engine.draft = draft if speculative else None
+        for k in calls:
+            calls[k] = 0
+        t0 = time.perf_counter()
+        q = engine.generate(history, max_new_tokens=max_new_tokens, temperature=0)
+        return q, time.perf_counter() - t0, engine.last_new_tokens, dict(calls)
+
+    run(examples[0]["history"], False)   # warm-up both paths
+    run(examples[0]["history"], True)
+    base_lat, spec_lat, same = [], [], []
+    new_tokens = rounds = proposed = 0
+    for ex in examples:
+        q_base, lat, _, _ = run(ex["history"], False)
+        base_lat.append(lat)
+        q_spec, lat, n, c = run(ex["history"], True)
+        spec_lat.append(lat)
+        same.append(float(q_base == q_spec))
+        # each verification round = one target forward, yielding its accepted draft tokens + 1
+        new_tokens += n
+        rounds += c["target"]
+        proposed += c["draft"]
+    for h in hooks:
+        h.remove()
+    engine.draft = draft
+
+    accepted = max(new_tokens - rounds, 0)
+    return {
+        "target": engine.merged_dir or engine.base_model,
+        "draft": engine.draft_name,
+        "examples": len(examples),
+        "draft_tokens": draft_tokens,
+        "acceptance_rate": round(accepted / proposed, 3) if proposed else None,
+        "tokens_per_target_forward": round(new_tokens / rounds, 2) if rounds else None,
+        "latency_ms_plain": _ms(base_lat),
+        "latency_ms_speculative": _ms(spec_lat),
+        "speedup": round(statistics.mean(base_lat) / statistics.mean(spec_lat), 2),
+        "greedy_agreement": round(statistics.mean(same), 4),
+    }
+
+@torch.inference_mode()
+def bench_semantic_cache(adapter_dir: str, csv_path: str, limit: int, thresholds: List[float],
+                         embedders: List[str]) -> Dict:
+    from followup.response_cache import semantic_text, hidden_state_embedder, token_embedder
+    # distinct first turns -> the doctor's first question (a conservative "right answer")
+    firsts: Dict[str, str] = {}
+    for ex in load_heldout_examples(csv_path, frac=1.0):
+        if len(ex["history"]) == 1:
+            firsts.setdefault(semantic_text(ex["history"]), normalize_question(ex["reference"]))
+    texts = list(firsts)[:limit] if limit else list(firsts)
+    refs = [firsts[t] for t in texts]
+    engine = FollowUpEngine(adapter_dir)
+    report = {"adapter_dir": adapter_dir, "first_turns": len(texts)}
+    for name in embedders:
+        embed = {"hidden": hidden_state_embedder, "token": token_embedder}[name](engine)
+        matrix = torch.stack([embed(t) for t in texts])
+        sims = matrix @ matrix.T
+        sims.fill_diagonal_(-1.0)   # leave-one-out: the cache holds every other first turn
+        best, nearest = sims.max(dim=1)
+        rows = []
+        for t in sorted(thresholds):
+            hits = [i for i in range(len(texts)) if float(best[i]) >= t]
+            false = [i for i in hits if refs[int(nearest[i])] != refs[i]]
+            rows.append({
+                "threshold": t,
+                "hit_rate": round(len(hits) / max(len(texts), 1), 4),
+                "false_hit_rate": round(len(false) / max(len(texts), 1), 4),
+                "false_hits_per_hit": round(len(false) / len(hits), 4) if hits else None,
+                "false_examples": [[texts[i], texts[int(nearest[i])], round(float(best[i]), 4)] for i in false[:3]],
+            })
+        safe = [r["threshold"] for r in rows if r["false_hit_rate"] == 0]
+        report[name] = {"thresholds": rows, "lowest_threshold_without_false_hits": min(safe) if safe else None}
+    return report
+
+# Runs in a fresh interpreter per measurement (this module imports torch itself), with cwd set
+# to the tree being measured, so the same probe times this tree and a baseline worktree.
+# import_s includes whatever a module does at import (pip, model load); first_question_s
+# includes loading when the tree defers it. Every path samples with its own defaults (the
+# original tester only samples) from a fixed seed, set once the imports are timed.
+STARTUP_PROBE = r"""
+import json, sys, time
+t0 = time.perf_counter()
+mode, adapter_dir = sys.argv[1], sys.argv[2]
+sys.path.insert(0, ".")
+emit = lambda **kv: print("@@probe " + json.dumps(kv), flush=True)
+def seed():
+    from transformers import set_seed
+    set_seed(0)
+history = [{"role": "patient", "content": "I've had a dull headache for 3 days and mild fever."}]
+if mode == "training":
+    import training
+    t_import = time.perf_counter()
+    emit(import_s=t_import - t0)
+    seed()
+    q = training.generateNextQuestion(adapter_dir, history)
+elif mode == "test":
+    import test   # stdin "q" ends the loop older testers ran at import
+    t_import = time.perf_counter()
+    emit(import_s=t_import - t0)
+    test.ADAPTER_DIR = adapter_dir   # trees with a lazy tester load on the first question
+    seed()
+    q = test.gen_one_question(history)
+else:
+    try:
+        from followup import get_engine
+    except ImportError:
+        from inference import get_engine   # trees before the followup package
+    t_import = time.perf_counter()
+    emit(import_s=t_import - t0)
+    kwargs = {"mmap_weights": True} if mode == "engine+mmap" else {}
+    seed()
+    q = get_engine(adapter_dir, **kwargs).generate(history)
+emit(first_question_s=time.perf_counter() - t_import, question=q)
+"""
+
+STARTUP_MODES = ["engine", "engine+mmap", "training", "test"]
+
+def _startup_runs(tree: str, adapter_dir: str, modes: List[str], repeats: int) -> Dict:
+    """Median phase timings per mode. A run that fails after its imports still reports import_s."""
+    report = {}
+    for mode in modes:
+        runs, error = [], None
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            out = subprocess.run([sys.executable, "-c", STARTUP_PROBE, mode, adapter_dir], cwd=tree, input="q\n",
+                                 capture_output=True, text=True)
+            probe = {"process_s": time.perf_counter() - t0}   # interpreter start → first question → exit
+            for line in out.stdout.splitlines():
+                if line.startswith("@@probe "):
+                    probe.update(json.loads(line[len("@@probe "):]))
+            if out.returncode != 0:
+                error = out.stderr.strip().splitlines()[-1] if out.stderr.strip() else f"exit {out.returncode}"
+                probe.pop("process_s")
+            runs.append(probe)
+        stats = {k: round(statistics.median(r[k] for r in runs), 3)
+                 for k in ("import_s", "first_question_s", "process_s") if runs and all(k in r for r in runs)}
+        if "import_s" in stats and "first_question_s" in stats:
+            stats["import_to_first_question_s"] = round(stats["import_s"] + stats["first_question_s"], 3)
+            stats["question"] = runs[-1]["question"]
+        if error:
+            stats["error"] = error
+        report[mode] = stats
+    return report
+
+def bench_startup(adapter_dir: str, modes: List[str], repeats: int, baseline: Optional[str]) -> Dict:
+    """This tree ("after") vs a git worktree of `baseline` ("before"), same probe and adapter."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    adapter_dir = os.path.abspath(adapter_dir)
+    report = {"adapter_dir": adapter_dir, "repeats": repeats,
+              "note": "page cache stays warm between runs; the first run of the first mode pays disk reads",
+              "after": _startup_runs(here, adapter_dir, modes, repeats)}
+    if not baseline:
+        return report
+
+    git = lambda *a: subprocess.run(["git", *a], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+    root, prefix = git("rev-parse", "--show-toplevel"), git("rev-parse", "--show-prefix")
+    with tempfile.TemporaryDirectory(prefix="fuq-baseline-") as d:
+        tree = os.path.join(d, "wt")
+        git("worktree", "add", "--detach", tree, baseline)
+        try:
+            sub = os.path.join(tree, prefix)
+            # the testers use a relative ADAPTER_DIR: point the baseline's at the same adapter
+            local = os.path.join(sub, "followuplora")
+            if os.path.realpath(local) != adapter_dir:
+                import shutil
+                shutil.rmtree(local, ignore_errors=True)
+                os.symlink(adapter_dir, local)
+            before_modes = [m for m in modes if m != "engine+mmap"]   # mmap loading did not exist before
+            report["before"] = {"ref": git("rev-parse", "--short", baseline),
+                                **_startup_runs(sub, adapter_dir, before_modes, repeats)}
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", tree], cwd=root, capture_output=True)
+    report["speedup"] = {
+        m: round(report["before"][m]["import_to_first_question_s"] / report["after"][m]["import_to_first_question_s"], 2)
+        for m in modes
+        if "import_to_first_question_s" in report["before"].get(m, {}) and "import_to_first_question_s" in report["after"].get(m, {})
+    }
+    return report
+
+def bench_ddp_scaling(csv_path: str, base_model: str, procs: List[int], steps: int,
+                      batch: int, seq_len: int) -> Dict:
+    from dataprep import prepareSftJsonl
+    from training import launchCpuDdp
+    work = tempfile.mkdtemp(prefix="fuq-ddp-")
+    jsonl = os.path.join(work, "train.jsonl")
+    prepareSftJsonl(csv_path, jsonl, assumeSorted=True)
+    cores = os.cpu_count() or 1
+    report = {"base_model": base_model, "cores": cores, "steps": steps,
+              "per_process_batch": batch, "seq_len": seq_len, "runs": {}}
+    for n in procs:
+        if n > cores:
+            continue
+        out = os.path.join(work, f"metrics-{n}.json")
+        rc = launchCpuDdp(n, os.path.abspath(__file__), [
+            "ddp-worker", "--jsonl", jsonl, "--base-model", base_model, "--steps", str(steps),
+            "--batch", str(batch), "--seq-len", str(seq_len), "--cache-dir", os.path.join(work, "cache"),
+            "--metrics-out", out,
+        ])
+        if rc != 0 or not os.path.exists(out):
+            report["runs"][n] = {"error": f"exit code {rc}"}
+            continue
+        with open(out, "r", encoding="utf-8") as f:
+            m = json.load(f)
+        report["runs"][n] = {
+            "threads_per_process": max(1, cores // n),
+            "train_runtime_s": round(m["train_runtime"], 2),
+            "samples_per_sec": round(m["train_samples_per_second"], 3),
+            "tokens_per_sec": round(m["train_samples_per_second"] * seq_len, 1),
+        }
+    ok = {n: r for n, r in report["runs"].items() if "error" not in r}
+    if 1 in ok:
+        for n, r in ok.items():
+            r["speedup_vs_1"] = round(r["tokens_per_sec"] / ok[1]["tokens_per_sec"], 2)
+            r["efficiency"] = round(r["speedup_vs_1"] / n, 2)
+    return report
+
+def ddp_worker(args) -> None:
+    # One rank of a ddp-scaling run (started by torch.distributed.run, see bench_ddp_scaling)
+    import training
+    training.initCpuDdp()
+    rank, worldSize = training.distInfo()
+    metrics = training.trainLoraSft(
+        baseModel=args.base_model,
+        trainJsonl=args.jsonl,
+        outDir=os.path.join(os.path.dirname(args.metrics_out), f"adapter-{os.path.basename(args.metrics_out)}"),
+        maxSeqLen=args.seq_len,
+        epochs=1,
+        trainBatchPerDev=args.batch,
+        gradAccum=worldSize,   # one micro-step per rank per optimizer step
+        lr=training.lr,
+        loraR=training.loraR,
+        loraAlpha=training.loraAlpha,
+        loraDropout=training.loraDropout,
+        saveSteps=training.saveSteps,
+        loggingSteps=training.loggingSteps,
+        seed=training.seed,
+        cacheDir=args.cache_dir,
+        model=training.tryLoadBaseModel(args.base_model),
+        maxSteps=args.steps,
+    )
+    if rank == 0:
+        with open(args.metrics_out, "w", encoding="utf-8") as w:
+            json.dump(metrics, w)
+    training.dist.destroy_process_group()
+
+def main():
+    ap = argparse.ArgumentParser(description="Follow-up generator benchmarks.")
+    ap.add_argument("--out", default=None, help="also write the JSON report here")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("prefix", help="shared system-prompt KV cache vs full prefill")
+    p.add_argument("--models", nargs="+", default=SIZES)
+    p.add_argument("--repeats", type=int, default=10)
+
+    p = sub.add_parser("cpu-profiles", help="fp32 vs bf16 vs int8 accuracy/latency on held-out rows")
+    p.add_argument("--adapter-dir", default="followuplora")
+    p.add_argument("--csv", default="conversation_data.csv")
+    p.add_argument("--limit", type=int, default=40)
+    p.add_argument("--threads", type=int, default=None)
+    p.add_argument("--profiles", nargs="+", choices=CPU_PROFILES, default=list(CPU_PROFILES))
+
+    p = sub.add_parser("early-stop", help="tokens/latency saved by stopping at the first '?'")
+    p.add_argument("--adapter-dir", default="followuplora")
+    p.add_argument("--repeats", type=int, default=5)
+    p.add_argument("--max-new-tokens", type=int, default=32)
+
+    p = sub.add_parser("latency", help="replayed-conversation latency/throughput (p50/p95/p99, TTFT, q/s)")
+    p.add_argument("--adapter-dir", default="followuplora")
+    p.add_argument("--csv", default="conversation_data.csv")
+    p.add_argument("--limit", type=int, default=200)
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8],
+                   help="1 = engine.generate per request; >1 = MicroBatchScheduler(max_batch_size=N)")
+    p.add_argument("--max-new-tokens", type=int, default=32)
+    p.add_argument("--temperature", type=float, default=0.0, help="0 = greedy (reproducible)")
+    p.add_argument("--max-wait-ms", type=float, default=20.0)
+    p.add_argument("--cpu-profile", choices=CPU_PROFILES, default="fp32")
+    p.add_argument("--threads", type=int, default=None)
+
+    p = sub.add_parser("speculative", help="draft-model speculative decoding: acceptance rate and speedup")
+    p.add_argument("--adapter-dir", default="followuplora", help="target (e.g. the 1.5B LoRA)")
+    p.add_argument("--draft-model", default=SIZES[0])
+    p.add_argument("--draft-adapter-dir", default=None)
+    p.add_argument("--csv", default="conversation_data.csv")
+    p.add_argument("--limit", type=int, default=40)
+    p.add_argument("--max-new-tokens", type=int, default=32)
+    p.add_argument("--draft-tokens", type=int, default=5)
+
+    p = sub.add_parser("semantic-cache", help="response-cache similarity tier: false-hit rate per threshold")
+    p.add_argument("--adapter-dir", default="followuplora")
+    p.add_argument("--csv", default="conversation_data.csv")
+    p.add_argument("--limit", type=int, default=0)
+    p.add_argument("--thresholds", type=float, nargs="+", default=[0.9, 0.95, 0.97, 0.98, 0.99, 0.995])
+    p.add_argument("--embedders", nargs="+", choices=["hidden", "token"], default=["hidden", "token"])
+
+    p = sub.add_parser("startup", help="import-to-first-question time, this tree vs a baseline ref")
+    p.add_argument("--adapter-dir", default="followuplora")
+    p.add_argument("--modes", nargs="+", choices=STARTUP_MODES, default=STARTUP_MODES)
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--baseline", default=None, help="git ref measured the same way in a temporary worktree")
+
+    p = sub.add_parser("ddp-scaling", help="CPU LoRA SFT throughput vs number of DDP (gloo) processes")
+    p.add_argument("--csv", default="conversation_data.csv")
+    p.add_argument("--base-model", default=SIZES[0])
+    p.add_argument("--procs", type=int, nargs="+", default=[1, 2, 4, 8])
+    p.add_argument("--steps", type=int, default=20)
+    p.add_argument("--batch", type=int, default=1, help="per process; the global batch grows with --procs")
+    p.add_argument("--seq-len", type=int, default=768)
+
+    p = sub.add_parser("ddp-worker")   # internal: one rank of ddp-scaling
+    p.add_argument("--jsonl", required=True)
+    p.add_argument("--base-model", required=True)
+    p.add_argument("--steps", type=int, required=True)
+    p.add_argument("--batch", type=int, required=True)
+    p.add_argument("--seq-len", type=int, required=True)
+    p.add_argument("--cache-dir", required=True)
+    p.add_argument("--metrics-out", required=True)
+
+    args = ap.parse_args()
+    if args.cmd == "ddp-worker":
+        ddp_worker(args)
+        return
+    if args.cmd == "prefix":
+        report = bench_prefix(args.models, args.repeats)
+    elif args.cmd == "cpu-profiles":
+        report = bench_cpu_profiles(args.adapter_dir, args.csv, args.limit, args.threads, args.profiles)
+    elif args.cmd == "early-stop":
+        report = bench_early_stop(args.adapter_dir, args.repeats, args.max_new_tokens)
+    elif args.cmd == "latency":
+        report = bench_latency(args.adapter_dir, args.csv, args.limit, args.concurrency, args.batch_sizes,
+                               args.max_new_tokens, args.temperature, args.max_wait_ms,
+                               args.cpu_profile, args.threads)
+    elif args.cmd == "speculative":
+        report = bench_speculative(args.adapter_dir, args.draft_model, args.draft_adapter_dir, args.csv,
+                                   args.limit, args.max_new_tokens, args.draft_tokens)
+    elif args.cmd == "semantic-cache":
+        report = bench_semantic_cache(args.adapter_dir, args.csv, args.limit, args.thresholds, args.embedders)
+    elif args.cmd == "startup":
+        report = bench_startup(args.adapter_dir, args.modes, args.repeats, args.baseline)
+    elif args.cmd == "ddp-scaling":
+        report = bench_ddp_scaling(args.csv, args.base_model, args.procs, args.steps, args.batch, args.seq_len)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as w:
+            w.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
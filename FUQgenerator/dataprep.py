@@ -0,0 +1,381 @@
+# ============================================================
+# Data prep: CSV/TSV → SFT chat pairs (streaming)
+# rows → conversations → pairs → JSONL, one generator feeding the next,
+# so peak memory does not grow with the size of the export.
+#
+# Conversation grouping:
+#   assumeSorted=True   rows of one ID are contiguous (our exports are):
+#                       a conversation is emitted as soon as the ID changes;
+#                       an ID seen again later raises (memory ~ number of IDs)
+#   assumeSorted=False  rows are spilled to hash buckets on disk and each
+#                       bucket is grouped on its own (memory ~ input / numBuckets)
+#
+# Token-aware helpers (tokenizer passed in): chatTemplateRoles maps the
+# patient/doctor turns onto the roles Qwen's chat template renders (it
+# silently drops any other role); trimToTokenBudget drops the
+# oldest history turns until an example fits; lengthGroupedBatches +
+# paddingEfficiency measure how much padding length bucketing saves.
+#
+# Many ward exports at once (one process per file, merged + de-duplicated):
+#   python dataprep.py "exports/*.csv" "exports/*.tsv" -o train.jsonl --workers 8 --sorted
+# ============================================================
+
+import os, csv, json, tempfile, zlib, glob, hashlib, time, argparse, random
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import List, Dict, Tuple, Iterator, Iterable, Optional
+
+Turn = Tuple[str, str]   # (patient utterance, doctor question)
+
+# One system prompt for training and inference (followup.engine builds its KV prefix from it)
+from followup.engine import SYS_MSG as sftSysMsg
+
+def iterCsvRows(csvPath: str, stats: Optional[Dict] = None) -> Iterator[Tuple[str, str, str]]:
+    """Yield (id, patient, doctor) for every usable row; counts go into stats."""
+    if not os.path.exists(csvPath):
+        raise FileNotFoundError(f"CSV/TSV not found at {csvPath}")
+
+    def pick(row, keys, default=""):
+        for k in keys:
+            if k in row and row[k] is not None:
+                return str(row[k])
+        return default
+
+    if stats is None:
+        stats = {}
+    stats.setdefault("rows", 0)
+    stats.setdefault("kept", 0)
+
+    with open(csvPath, "r", encoding="utf-8", newline="") as f:
+        # --- Detect delimiter (tab vs comma) and header ---
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",\t;|")
+            has_header = csv.Sniffer().has_header(sample)
+        except Exception:
+            dialect = csv.get_dialect("excel")
+            dialect.delimiter = "\t" if "\t" in sample else ","
+            has_header = True
+
+        if has_header:
+            for row in csv.DictReader(f, dialect=dialect):
+                stats["rows"] += 1
+                rid     = pick(row, ["id","ID","Id"]).strip()
+                patient = pick(row, ["patient","Patient","Patient_Answer","user","customer"]).strip()
+                doctor  = pick(row, ["doctor","Doctor","Doctor_response","assistant","question"]).strip()
+                if rid and (patient or doctor):
+                    stats["kept"] += 1
+                    yield rid, patient, doctor
+        else:
+            for row in csv.reader(f, dialect=dialect):
+                stats["rows"] += 1
+                if not row or len(row) < 3: continue
+                rid     = (row[0] or "").strip()
+                patient = (row[1] or "").strip()
+                doctor  = (row[2] or "").strip()
+                if rid and (patient or doctor):
+                    stats["kept"] += 1
+                    yield rid, patient, doctor
+
+def iterConversations(
+    rows: Iterable[Tuple[str, str, str]],
+    assumeSorted: bool = False,
+    numBuckets: int = 64,
+    tmpDir: Optional[str] = None
+) -> Iterator[Tuple[str, List[Turn]]]:
+    """Group (id, patient, doctor) rows into (id, [(patient, doctor), ...])."""
+    if assumeSorted:
+        curId, turns = None, []
+        seen = set()
+        for rid, patient, doctor in rows:
+            if rid != curId:
+                if rid in seen:
+                    # splitting it would silently drop the earlier turns from its history
+                    raise ValueError(f"Conversation {rid!r} reappears after other IDs: rows are not "
+                                     f"grouped by ID; rerun with assumeSorted=False (--sorted off)")
+                seen.add(rid)
+                if turns:
+                    yield curId, turns
+                curId, turns = rid, []
+            turns.append((patient, doctor))
+        if turns:
+            yield curId, turns
+        return
+
+    with tempfile.TemporaryDirectory(dir=tmpDir, prefix="fuq-buckets-") as d:
+        paths = [os.path.join(d, f"bucket-{i:03d}.jsonl") for i in range(numBuckets)]
+        handles = [open(p, "w", encoding="utf-8") for p in paths]
+        try:
+            for rid, patient, doctor in rows:
+                b = zlib.crc32(rid.encode("utf-8")) % numBuckets
+                handles[b].write(json.dumps([rid, patient, doctor], ensure_ascii=False) + "\n")
+        finally:
+            for h in handles:
+                h.close()
+
+        for p in paths:
+            byId: Dict[str, List[Turn]] = {}
+            with open(p, "r", encoding="utf-8") as f:
+                for line in f:
+                    rid, patient, doctor = json.loads(line)
+                    byId.setdefault(rid, []).append((patient, doctor))
+            yield from byId.items()
+
+def isHeldout(convId: str, frac: float = 0.05) -> bool:
+    """Whole conversations whose ID hashes into the last `frac` of the space (stable across runs and row order)."""
+    bucket = int(hashlib.sha1(convId.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return bucket >= 1.0 - frac
+
+def iterSftPairs(
+    convos: Iterable[Tuple[str, List[Turn]]],
+    maxTurnsPerExample: int = 40,
+    maxHistoryTurns: int = 8,
+    minQuestionLen: int = 3,
+    heldoutFrac: float = 0.0
+) -> Iterator[Dict]:
+    """heldoutFrac: skip the conversations isHeldout reserves (evaluation.py scores those)."""
+    for convId, turns in convos:
+        if heldoutFrac > 0 and isHeldout(convId, heldoutFrac):
+            continue
+        running = []
+        used = 0
+        for (patientUtterance, doctorQuestion) in turns:
+            if patientUtterance:
+                running.append({"role": "patient", "content": patientUtterance})
+
+            if doctorQuestion:
+                dq = doctorQuestion.strip()
+                if len(dq) >= minQuestionLen and ("?" in dq or dq.endswith("?")):
+                    trimmed = running[-maxHistoryTurns:] if maxHistoryTurns > 0 else running
+                    messages = [{"role": "system", "content": sftSysMsg}] + trimmed + [
+                        {"role": "assistant", "content": dq}
+                    ]
+                    yield {"messages": messages}
+                    used += 1
+                    if maxTurnsPerExample > 0 and used >= maxTurnsPerExample:
+                        break
+                # append as a 'doctor' role to history for context drift
+                running.append({"role": "doctor", "content": doctorQuestion})
+
+@contextmanager
+def atomicWriter(outPath: str):
+    """Text handle on outPath + ".tmp", renamed over outPath on success and removed on error."""
+    os.makedirs(os.path.dirname(outPath) or ".", exist_ok=True)
+    tmpPath = outPath + ".tmp"
+    try:
+        with open(tmpPath, "w", encoding="utf-8") as w:
+            yield w
+        os.replace(tmpPath, outPath)
+    except BaseException:
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+        raise
+
+def saveJsonl(pairs: Iterable[Dict], outPath: str) -> int:
+    """Write pairs as they arrive (tmp file + rename); returns how many were written."""
+    n = 0
+    with atomicWriter(outPath) as w:
+        for ex in pairs:
+            w.write(json.dumps(ex, ensure_ascii=False) + "\n")
+            n += 1
+    return n
+
+def pairKey(line: str) -> bytes:
+    """Identity of one serialized example (a JSONL line); equal lines are duplicates."""
+    return hashlib.sha1(line.encode("utf-8")).digest()
+
+def dropDuplicatePairs(pairs: Iterable[Dict], stats: Dict) -> Iterator[Dict]:
+    """Yield each distinct example once (memory ~ 20 bytes per distinct example)."""
+    seen = set()
+    stats.setdefault("duplicates_dropped", 0)
+    for ex in pairs:
+        key = pairKey(json.dumps(ex, ensure_ascii=False) + "\n")
+        if key in seen:
+            stats["duplicates_dropped"] += 1
+            continue
+        seen.add(key)
+        yield ex
+
+def prepareSftJsonl(csvPath: str, outPath: str, assumeSorted: bool = False, **pairKwargs) -> int:
+    """CSV → JSONL end to end without holding the dataset in memory; exact duplicate
+    examples are dropped, as prepareManyCsv does, so one file gives the same set either way."""
+    stats: Dict = {}
+    convos = iterConversations(iterCsvRows(csvPath, stats), assumeSorted=assumeSorted)
+    counted = {"conversations": 0}
+
+    def _count(it):
+        for c in it:
+            counted["conversations"] += 1
+            yield c
+
+    n = saveJsonl(dropDuplicatePairs(iterSftPairs(_count(convos), **pairKwargs), stats), outPath)
+    print(f"[CSV] rows read: {stats['rows']}, kept: {stats['kept']}, conversations: {counted['conversations']}, "
+          f"duplicate examples dropped: {stats['duplicates_dropped']}")
+    return n
+
+# ---- Token budget + length bucketing ----
+def chatTemplateRoles(messages: List[Dict]) -> List[Dict]:
+    """
+    patient -> user, doctor/assistant -> assistant, system kept, anything else -> user
+    (the same rule as followup.engine.map_roles_for_qwen, which inference applies).
+    Apply before every apply_chat_template call on stored pairs.
+    """
+    roles = {"system": "system", "assistant": "assistant", "doctor": "assistant", "patient": "user"}
+    return [{"role": roles.get(m.get("role", "user").lower(), "user"), "content": m.get("content", "")}
+            for m in messages]
+
+def exampleTokenCount(tok, messages: List[Dict]) -> int:
+    return len(tok.apply_chat_template(chatTemplateRoles(messages), tokenize=True))
+
+def trimToTokenBudget(messages: List[Dict], tok, maxTokens: int) -> Tuple[Optional[List[Dict]], int]:
+    """
+    Keep the system prompt and the target question, drop the oldest history
+    turns until the chat-templated example is <= maxTokens. Returns
+    (messages, tokenCount), or (None, 0) if even an empty history is too long.
+    """
+    n = exampleTokenCount(tok, messages)
+    if n <= maxTokens:
+        return messages, n
+    head, hist, tail = messages[:1], messages[1:-1], messages[-1:]
+    # token count only shrinks as more turns are dropped -> binary search
+    lo, hi, best = 1, len(hist), (None, 0)
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        trimmed = head + hist[mid:] + tail
+        k = exampleTokenCount(tok, trimmed)
+        if k <= maxTokens:
+            best, hi = (trimmed, k), mid - 1
+        else:
+            lo = mid + 1
+    return best
+
+def lengthGroupedBatches(lengths: List[int], batchSize: int, seed: int = 42, megaBatchMult: int = 50) -> List[List[int]]:
+    """Batches as transformers' LengthGroupedSampler forms them: shuffle, then sort by length inside mega-batches."""
+    rng = random.Random(seed)
+    idx = list(range(len(lengths)))
+    rng.shuffle(idx)
+    mega = max(1, batchSize * megaBatchMult)
+    batches = []
+    for i in range(0, len(idx), mega):
+        chunk = sorted(idx[i:i + mega], key=lambda j: lengths[j], reverse=True)
+        batches.extend(chunk[k:k + batchSize] for k in range(0, len(chunk), batchSize))
+    return batches
+
+def paddingEfficiency(lengths: List[int], batches: List[List[int]]) -> float:
+    """Real tokens / tokens actually computed once each batch is padded to its longest row."""
+    real = sum(lengths[j] for b in batches for j in b)
+    padded = sum(max(lengths[j] for j in b) * len(b) for b in batches if b)
+    return real / padded if padded else 1.0
+
+# ---- Many files: one shard per file on a process pool ----
+def _prepareShard(job: Tuple[str, str, bool, Dict]) -> Dict:
+    csvPath, shardOut, assumeSorted, pairKwargs = job
+    t0 = time.perf_counter()
+    stats: Dict = {}
+    convos = iterConversations(iterCsvRows(csvPath, stats), assumeSorted=assumeSorted)
+    n = saveJsonl(iterSftPairs(convos, **pairKwargs), shardOut)
+    return {"path": csvPath, "rows": stats["rows"], "kept": stats["kept"], "pairs": n,
+            "seconds": round(time.perf_counter() - t0, 3)}
+
+def prepareManyCsv(
+    patterns: List[str],
+    outPath: str,
+    workers: Optional[int] = None,
+    assumeSorted: bool = False,
+    **pairKwargs
+) -> Dict:
+    """
+    Expand the glob patterns, build pairs for each file in its own worker
+    process, then concatenate the shards in sorted-file order into outPath,
+    dropping exact duplicate examples. Conversations never span files, so
+    each ID's examples stay together and in their original order.
+    """
+    files = sorted({p for pat in patterns for p in glob.glob(pat)})
+    if not files:
+        raise FileNotFoundError(f"No CSV/TSV files match {patterns}")
+    workers = max(1, min(workers or os.cpu_count() or 1, len(files)))
+
+    t0 = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="fuq-shards-") as d:
+        jobs = [(f, os.path.join(d, f"shard-{i:05d}.jsonl"), assumeSorted, pairKwargs) for i, f in enumerate(files)]
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            shards = list(ex.map(_prepareShard, jobs))   # map keeps input order
+
+        seen = set()
+        written = dupes = 0
+        with atomicWriter(outPath) as w:
+            for _, shardOut, _, _ in jobs:
+                with open(shardOut, "r", encoding="utf-8") as f:
+                    for line in f:
+                        key = pairKey(line)
+                        if key in seen:
+                            dupes += 1
+                            continue
+                        seen.add(key)
+                        w.write(line)
+                        written += 1
+
+    elapsed = time.perf_counter() - t0
+    rows = sum(s["rows"] for s in shards)
+    report = {
+        "files": len(files),
+        "workers": workers,
+        "rows": rows,
+        "pairs": written,
+        "duplicates_dropped": dupes,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(rows / elapsed, 1) if elapsed > 0 else None,
+        "shards": shards,
+    }
+    print(f"[CSV] {len(files)} files, {rows} rows → {written} pairs ({dupes} duplicates dropped) "
+          f"in {elapsed:.1f}s with {workers} workers = {report['rows_per_sec']} rows/s")
+    return report
+
+# ---- In-memory helpers (small files / interactive use) ----
+def loadConvosFromCsv(csvPath: str) -> Dict[str, List[Turn]]:
+    stats: Dict = {}
+    byId: Dict[str, List[Turn]] = {}
+    for rid, patient, doctor in iterCsvRows(csvPath, stats):
+        byId.setdefault(rid, []).append((patient, doctor))
+    print(f"[CSV] rows read: {stats['rows']}, kept: {stats['kept']}, conversations: {len(byId)}")
+    return byId
+
+def buildSftPairs(
+    byId: Dict[str, List[Turn]],
+    maxTurnsPerExample: int = 40,
+    maxHistoryTurns: int = 8,
+    minQuestionLen: int = 3,
+    heldoutFrac: float = 0.0
+) -> List[Dict]:
+    return list(iterSftPairs(byId.items(), maxTurnsPerExample, maxHistoryTurns, minQuestionLen, heldoutFrac))
+
+def main():
+    ap = argparse.ArgumentParser(description="CSV/TSV conversation exports → SFT train JSONL.")
+    ap.add_argument("patterns", nargs="+", help="files or glob patterns (quote them)")
+    ap.add_argument("-o", "--out", default="train.jsonl")
+    ap.add_argument("--workers", type=int, default=None, help="default: one per core")
+    ap.add_argument("--sorted", action="store_true", help="rows of one ID are contiguous in every file")
+    ap.add_argument("--max-history-turns", type=int, default=8)
+    ap.add_argument("--max-turns-per-example", type=int, default=40)
+    ap.add_argument("--heldout-frac", type=float, default=0.05,
+                    help="conversations reserved for evaluation.py (0 = keep everything)")
+    ap.add_argument("--report", default=None, help="write the JSON throughput report here")
+    args = ap.parse_args()
+
+    report = prepareManyCsv(
+        args.patterns, args.out,
+        workers=args.workers,
+        assumeSorted=args.sorted,
+        maxHistoryTurns=args.max_history_turns,
+        maxTurnsPerExample=args.max_turns_per_example,
+        heldoutFrac=args.heldout_frac,
+    )
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as w:
+            json.dump(report, w, indent=2)
+
+if __name__ == "__main__":
+    main()
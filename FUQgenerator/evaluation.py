@@ -0,0 +1,258 @@
+# ============================================
+# Held-out examples + follow-up question quality metrics
+# - Held-out = whole conversations whose ID hashes into the last `frac`
+#   of the space (dataprep.isHeldout; training excludes the same ones via
+#   pairParams["heldoutFrac"], so keep the two fractions equal)
+# - Each example: patient/doctor history so far -> reference doctor question
+# - Batch runner: greedy left-padded generate_batch over the eval split,
+#   optionally across worker processes; every finished batch is appended
+#   to a progress JSONL, so an interrupted run resumes where it stopped.
+#   Records are keyed by (adapter weights + decode settings, example
+#   content): another adapter or a rebuilt JSONL never reuses old scores
+#
+# Run:  python evaluation.py --adapter-dir followuplora --jsonl train.jsonl --workers 4
+# ============================================
+
+import argparse, hashlib, json, math, multiprocessing, os, statistics, time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Optional
+
+from followup.engine import adapter_fingerprint, normalize_question, postprocess
+from dataprep import iterCsvRows, iterConversations, isHeldout as is_heldout
+
+def load_heldout_examples(
+    csv_path: str,
+    frac: float = 0.05,
+    limit: int = 0,
+    max_history_turns: int = 8,
+    assume_sorted: bool = True
+) -> List[Dict]:
+    """[{"id", "history": [{role, content}], "reference": str}] from held-out conversations."""
+    examples = []
+    for conv_id, turns in iterConversations(iterCsvRows(csv_path), assumeSorted=assume_sorted):
+        if not is_heldout(conv_id, frac):
+            continue
+        running = []
+        for patient, doctor in turns:
+            if patient:
+                running.append({"role": "patient", "content": patient})
+            if doctor and "?" in doctor and running:
+                examples.append({
+                    "id": conv_id,
+                    "history": running[-max_history_turns:],
+                    "reference": doctor,
+                })
+                if limit and len(examples) >= limit:
+                    return examples
+            if doctor:
+                running.append({"role": "doctor", "content": doctor})
+    return examples
+
+def load_eval_split(jsonl_path: str, split_train: float = 0.95, seed: int = 42, limit: int = 0) -> List[Dict]:
+    """The split training.buildDataset holds out (same test_size and seed), as history -> reference."""
+    from datasets import load_dataset
+    ds = load_dataset("json", data_files=jsonl_path, split="train")
+    ds = ds.train_test_split(test_size=1.0 - split_train, seed=seed)["test"]
+    examples = []
+    for ex in ds:
+        msgs = ex["messages"]
+        examples.append({
+            "history": [m for m in msgs[:-1] if m["role"] != "system"],
+            "reference": msgs[-1]["content"],
+        })
+        if limit and len(examples) >= limit:
+            break
+    return examples
+
+def example_key(ex: Dict) -> str:
+    """Content hash of one example: the same history + reference always maps to the same key."""
+    body = json.dumps([ex["history"], ex["reference"]], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+def run_key(adapter_dir: str, max_new_tokens: int, cpu_profile: str) -> str:
+    """What produced the predictions: adapter weights (or the dir, for merged-only exports) + decode settings."""
+    weights = adapter_fingerprint(adapter_dir) or os.path.abspath(adapter_dir)
+    return hashlib.sha1(json.dumps([weights, max_new_tokens, cpu_profile]).encode("utf-8")).hexdigest()[:16]
+
+def _tokens(text: str) -> List[str]:
+    return normalize_question(text).split()
+
+def token_f1(pred: str, ref: str) -> float:
+    p, r = _tokens(pred), _tokens(ref)
+    if not p or not r:
+        return float(p == r)
+    common = defaultdict(int)
+    for t in r:
+        common[t] += 1
+    overlap = 0
+    for t in p:
+        if common[t] > 0:
+            overlap += 1
+            common[t] -= 1
+    if overlap == 0:
+        return 0.0
+    precision, recall = overlap / len(p), overlap / len(r)
+    return 2 * precision * recall / (precision + recall)
+
+def bleu(pred: str, ref: str, max_n: int = 4) -> float:
+    """Sentence BLEU over normalized tokens, add-one smoothing for n > 1 (short questions)."""
+    p, r = _tokens(pred), _tokens(ref)
+    if not p or not r:
+        return float(p == r)
+    log_sum = 0.0
+    for n in range(1, max_n + 1):
+        p_ngrams = Counter(tuple(p[i:i + n]) for i in range(len(p) - n + 1))
+        r_ngrams = Counter(tuple(r[i:i + n]) for i in range(len(r) - n + 1))
+        matched = sum(min(c, r_ngrams[g]) for g, c in p_ngrams.items())
+        total = max(len(p) - n + 1, 0)
+        if n == 1:
+            if matched == 0:
+                return 0.0
+            log_sum += math.log(matched / total)
+        else:
+            log_sum += math.log((matched + 1) / (total + 1))
+    brevity = 1.0 if len(p) > len(r) else math.exp(1 - len(r) / len(p))
+    return brevity * math.exp(log_sum / max_n)
+
+def is_well_formed(raw: str) -> bool:
+    """The model already produced one question postprocess would leave unchanged."""
+    text = raw.strip()
+    return bool(text) and postprocess(text) == text
+
+def score_prediction(raw: str, reference: str) -> Dict:
+    pred = postprocess(raw)
+    return {
+        "pred": pred,
+        "raw": raw,
+        "exact": float(pred.strip() == reference.strip()),
+        "normalized": float(normalize_question(pred) == normalize_question(reference)),
+        "f1": token_f1(pred, reference),
+        "bleu": bleu(pred, reference),
+        "well_formed": float(is_well_formed(raw)),
+    }
+
+METRICS = ("exact", "normalized", "f1", "bleu", "well_formed")
+
+# ---- batch runner ----
+_engine = None   # one per worker process
+
+def _init_worker(adapter_dir: str, cpu_profile: str, num_threads: Optional[int]):
+    global _engine
+    from followup.engine import FollowUpEngine
+    _engine = FollowUpEngine(adapter_dir, cpu_profile=cpu_profile, num_threads=num_threads)
+
+def _eval_batch(job) -> List[Dict]:
+    batch, max_new_tokens = job
+    # greedy: scores depend on the adapter, not on sampling luck
+    raws = _engine.generate_batch([ex["history"] for ex in batch], max_new_tokens=max_new_tokens,
+                                  temperature=0, raw=True)
+    return [{"key": ex["key"], "reference": ex["reference"], **score_prediction(raw, ex["reference"])}
+            for ex, raw in zip(batch, raws)]
+
+def _load_progress(path: str) -> Dict[str, Dict]:
+    """Finished records by key; a line torn by a crash is cut off so appends stay valid."""
+    done: Dict[str, Dict] = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb") as f:
+        data = f.read()
+    keep = data[:data.rfind(b"\n") + 1]
+    if len(keep) != len(data):
+        with open(path, "wb") as w:
+            w.write(keep)
+    for line in keep.decode("utf-8").splitlines():
+        if line.strip():
+            rec = json.loads(line)
+            done[rec["key"]] = rec
+    return done
+
+def summarize(records: List[Dict]) -> Dict:
+    return {m: round(statistics.mean(r[m] for r in records), 4) if records else None for m in METRICS}
+
+def run_eval(
+    examples: List[Dict],
+    adapter_dir: str,
+    progress_path: str,
+    batch_size: int = 8,
+    workers: int = 1,
+    max_new_tokens: int = 32,
+    cpu_profile: str = "fp32"
+) -> Dict:
+    """Score every example (skipping keys already in progress_path) and summarize all of them.
+    Keys combine run_key and example_key, so progress from another adapter, other decode
+    settings or other data is never counted for this run."""
+    t0 = time.perf_counter()
+    run = run_key(adapter_dir, max_new_tokens, cpu_profile)
+    examples = [{**ex, "key": f"{run}:{example_key(ex)}"} for ex in examples]
+    done = _load_progress(progress_path)
+    todo = [ex for ex in examples if ex["key"] not in done]
+    # similar prompt lengths share a batch: less left padding per generate()
+    todo.sort(key=lambda ex: sum(len(m["content"]) for m in ex["history"]))
+    jobs = [(todo[i:i + batch_size], max_new_tokens) for i in range(0, len(todo), batch_size)]
+    print(f"[eval] {len(examples)} examples, {len(done)} already scored, {len(jobs)} batches to run")
+
+    os.makedirs(os.path.dirname(progress_path) or ".", exist_ok=True)
+    with open(progress_path, "a", encoding="utf-8") as w:
+        def _write(records: List[Dict]):
+            for rec in records:
+                w.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                done[rec["key"]] = rec
+            w.flush()
+            print(f"[eval] {len(done)}/{len(examples)}")
+
+        if workers <= 1:
+            _init_worker(adapter_dir, cpu_profile, None)
+            for job in jobs:
+                _write(_eval_batch(job))
+        elif jobs:
+            # N processes × (cores / N) threads beats one process on many-core CPUs
+            threads = max(1, (os.cpu_count() or 1) // workers)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker,
+                                     initargs=(adapter_dir, cpu_profile, threads)) as ex:
+                for fut in as_completed([ex.submit(_eval_batch, job) for job in jobs]):
+                    _write(fut.result())
+
+    elapsed = time.perf_counter() - t0
+    records = [done[ex["key"]] for ex in examples if ex["key"] in done]
+    return {
+        "adapter_dir": adapter_dir,
+        "run_key": run,
+        "examples": len(records),
+        "generated_this_run": sum(len(b) for b, _ in jobs),
+        "seconds": round(elapsed, 1),
+        "examples_per_sec": round(sum(len(b) for b, _ in jobs) / elapsed, 2) if elapsed else None,
+        **summarize(records),
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="Batch evaluation of follow-up questions on the held-out split.")
+    ap.add_argument("--adapter-dir", default="followuplora")
+    ap.add_argument("--jsonl", default=None, help="SFT JSONL from training; scores buildDataset's eval split")
+    ap.add_argument("--csv", default="conversation_data.csv",
+                    help="used without --jsonl: hash-held-out conversations (excluded from training)")
+    ap.add_argument("--progress", default="eval_progress.jsonl", help="per-example records; rerun to resume")
+    ap.add_argument("--batch-size", type=int, default=8)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--max-new-tokens", type=int, default=32)
+    ap.add_argument("--cpu-profile", default="fp32")
+    ap.add_argument("--out", default=None, help="also write the JSON summary here")
+    args = ap.parse_args()
+
+    if args.jsonl:
+        examples = load_eval_split(args.jsonl, limit=args.limit)
+    else:
+        examples = load_heldout_examples(args.csv, limit=args.limit)
+    report = run_eval(examples, args.adapter_dir, args.progress, batch_size=args.batch_size,
+                      workers=args.workers, max_new_tokens=args.max_new_tokens, cpu_profile=args.cpu_profile)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as w:
+            w.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
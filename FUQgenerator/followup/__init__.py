@@ -0,0 +1,43 @@
+# ============================================
+# followup: follow-up question inference as a library
+# - engine:         FollowUpEngine / get_engine (resident model, KV reuse, streaming)
+# - session_cache:  per-conversation KV cache
+# - response_cache: exact + similarity answer cache
+# - batching:       micro-batching scheduler for concurrent callers
+#
+# `import followup` is cheap and has no side effects: submodules (and torch,
+# transformers, peft behind them) load on first attribute access / engine build.
+#
+#   from followup import get_engine
+#   engine = get_engine("followuplora")
+#   engine.generate([{"role": "patient", "content": "I have a headache."}])
+# ============================================
+
+import importlib
+
+_EXPORTS = {
+    "FollowUpEngine": "engine",
+    "get_engine": "engine",
+    "CPU_PROFILES": "engine",
+    "SYS_MSG": "engine",
+    "map_roles_for_qwen": "engine",
+    "postprocess": "engine",
+    "normalize_question": "engine",
+    "read_adapter_meta": "engine",
+    "detect_base_model": "engine",
+    "adapter_fingerprint": "engine",
+    "SessionKVCache": "session_cache",
+    "ResponseCache": "response_cache",
+    "token_embedder": "response_cache",
+    "hidden_state_embedder": "response_cache",
+    "MicroBatchScheduler": "batching",
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module 'followup' has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value   # later lookups skip __getattr__
+    return value
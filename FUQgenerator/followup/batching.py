@@ -0,0 +1,141 @@
+# ============================================
+# Micro-batching scheduler for follow-up questions
+# - Concurrent callers submit() a history and await their own question
+# - Requests arriving within max_wait_ms are padded together and served
+#   by ONE FollowUpEngine.generate_batch call (up to max_batch_size)
+# - metrics(): queue depth, batch fill, queue wait
+#
+# asyncio callers:   q = await scheduler.submit(history)
+# threaded callers:  scheduler.start_in_thread(); q = scheduler.submit_threadsafe(history)
+# ============================================
+
+import asyncio, threading, time
+from typing import List, Dict, Optional
+
+from .engine import FollowUpEngine
+
+class MicroBatchScheduler:
+    def __init__(
+        self,
+        engine: FollowUpEngine,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 20.0,
+        max_new_tokens: int = 32,
+        temperature: float = 0.8,
+        top_p: float = 0.9
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be >= 1")
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max(0.0, max_wait_ms) / 1000.0
+        # sampling knobs are per scheduler: one generate() can only use one setting
+        self.gen_kwargs = {"max_new_tokens": max_new_tokens, "temperature": temperature, "top_p": top_p}
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.n_requests = 0
+        self.n_batches = 0
+        self.max_queue_depth = 0
+        self.total_queue_wait_s = 0.0
+
+    # ---- lifecycle ----
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def start_in_thread(self):
+        """Run the scheduler on a private event loop (for threaded servers)."""
+        ready = threading.Event()
+
+        def _runner():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=_runner, name="fuq-batcher", daemon=True).start()
+        ready.wait()
+
+    # ---- submission ----
+    async def submit(self, history: List[Dict[str,str]]) -> str:
+        if self._queue is None:
+            raise RuntimeError("scheduler not started")
+        fut = self._loop.create_future()
+        await self._queue.put((history, fut, time.perf_counter()))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return await fut
+
+    def submit_threadsafe(self, history: List[Dict[str,str]], timeout: Optional[float] = None) -> str:
+        if self._loop is None:
+            raise RuntimeError("scheduler not started")
+        return asyncio.run_coroutine_threadsafe(self.submit(history), self._loop).result(timeout)
+
+    # ---- batching loop ----
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                # window closed; still take whatever is already waiting
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            now = time.perf_counter()
+            self.n_batches += 1
+            self.n_requests += len(batch)
+            self.total_queue_wait_s += sum(now - t for _, _, t in batch)
+
+            histories = [h for h, _, _ in batch]
+            try:
+                # generate() blocks; keep the loop free to keep queueing
+                questions = await self._loop.run_in_executor(
+                    None, lambda: self.engine.generate_batch(histories, **self.gen_kwargs)
+                )
+            except Exception as e:
+                for _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for (_, fut, _), q in zip(batch, questions):
+                if not fut.done():
+                    fut.set_result(q)
+
+    def metrics(self) -> Dict:
+        mean_batch = self.n_requests / self.n_batches if self.n_batches else 0.0
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "requests": self.n_requests,
+            "batches": self.n_batches,
+            "mean_batch_size": round(mean_batch, 2),
+            "batch_fill": round(mean_batch / self.max_batch_size, 3),
+            "mean_queue_wait_ms": round(self.total_queue_wait_s * 1000.0 / self.n_requests, 1) if self.n_requests else None,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_s * 1000.0,
+        }
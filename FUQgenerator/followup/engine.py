@@ -0,0 +1,659 @@
+# ============================================
+# Follow-up Question Inference Engine
+# - Loads base model + LoRA adapter ONCE and keeps it resident
+# - One engine per adapter dir (see get_engine)
+# - Tracks cold (load + first request) vs warm latency
+# - N distinct candidates from one shared prefill (generate_candidates)
+# - Left-padded multi-request generation (generate_batch, see followup.batching)
+# - Optional session_id: reuse the conversation's KV cache across turns
+# - System-prompt KV state computed once per model; every request starts there
+# - Prefers the merged artifact from merge_adapter.py when it is up to date
+# - CPU profiles: fp32 (default), bf16, int8 (dynamic quantization of Linear)
+# - stream(): partial text as it decodes, stopping once the question is complete
+# - QuestionStop: every generate path ends a sequence at its first '?' / 20 words
+# - Optional draft model (e.g. 0.5B, with or without adapter): speculative
+#   decoding via assistant_model in generate()/stream()
+# - Importing this module is free of side effects: torch / transformers /
+#   peft are imported when an engine is built or a tensor helper is called
+# - mmap_weights=True: local safetensors (e.g. the merged export) are mapped
+#   into the model's parameters instead of being read and copied
+# ============================================
+
+import os, json, re, time, threading, hashlib, functools, mmap, struct
+from typing import List, Dict, Optional, Iterator
+
+from .session_cache import SessionKVCache, crop_cache, common_prefix_len
+
+DEFAULT_BASE_MODEL = "Qwen/Qwen2.5-0.5B-Instruct"
+
+# The prompt the adapter is trained with (dataprep.sftSysMsg is this constant); the
+# system-prompt KV prefix is built from it, so inference must never drift from training.
+SYS_MSG = (
+    "You are a clinical assistant. Output ONLY the next, single best follow-up question to the patient. "
+    "Keep it concise (max 20 words). Do not provide diagnoses, reassurance, or instructions; ask a question. "
+    "End the sentence with a question mark."
+)
+
+ADAPTER_WEIGHTS = "adapter_model.safetensors"
+
+def read_adapter_meta(adapter_dir: str) -> Dict:
+    meta_path = os.path.join(adapter_dir, "adapter_meta.json")
+    if os.path.exists(meta_path):
+        try:
+            return json.load(open(meta_path, "r", encoding="utf-8"))
+        except Exception:
+            pass
+    return {}
+
+def detect_base_model(adapter_dir: str) -> str:
+    return read_adapter_meta(adapter_dir).get("base_model", DEFAULT_BASE_MODEL)
+
+def adapter_fingerprint(adapter_dir: str) -> Optional[str]:
+    """sha256 of the adapter weights; ties a merged export to the adapter it came from."""
+    p = os.path.join(adapter_dir, ADAPTER_WEIGHTS)
+    if not os.path.exists(p):
+        return None
+    h = hashlib.sha256()
+    with open(p, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def find_merged_model(adapter_dir: str) -> Optional[str]:
+    """Path of the merged export for adapter_dir, or None if missing or stale."""
+    meta = read_adapter_meta(adapter_dir)
+    merged = meta.get("merged_dir")
+    if not merged:
+        return None
+    path = os.path.join(adapter_dir, merged)
+    if not os.path.exists(os.path.join(path, "config.json")):
+        return None
+    if meta.get("merged_from") != adapter_fingerprint(adapter_dir):
+        return None   # adapter retrained since the export
+    return path
+
+def map_roles_for_qwen(history: List[Dict[str,str]]) -> List[Dict[str,str]]:
+    """
+    Convert custom roles to Qwen-friendly roles.
+    - 'patient' -> 'user'
+    - 'assistant' stays 'assistant'
+    - 'doctor' (if present) -> 'assistant'
+    - everything else -> 'user'
+    """
+    mapped = []
+    for m in history:
+        r = m.get("role","user").lower()
+        if r == "assistant":
+            role = "assistant"
+        elif r == "doctor":
+            role = "assistant"
+        elif r == "patient":
+            role = "user"
+        else:
+            role = "user"
+        mapped.append({"role": role, "content": m.get("content","")})
+    return mapped
+
+def postprocess(text: str) -> str:
+    text = text.strip()
+    # Keep first sentence-ish bit
+    seg = re.split(r"(?<=[\?\.\!])\s+", text, maxsplit=1)[0].strip()
+    # Force question mark if missing
+    if not seg.endswith("?"):
+        qpos = seg.find("?")
+        seg = seg[:qpos+1].strip() if qpos != -1 else (seg.rstrip(".! ") + "?").strip()
+    # Enforce ≤ 20 words
+    words = seg.split()
+    if len(words) > 20:
+        seg = " ".join(words[:20]) + "?"
+    return seg
+
+def normalize_question(q: str) -> str:
+    # Case/punctuation/whitespace-insensitive key used for de-duplication
+    return " ".join(re.sub(r"[^a-z0-9\s]", " ", q.lower()).split())
+
+def sampling_kwargs(temperature: float, top_p: float) -> Dict:
+    # temperature <= 0 means greedy (used by the comparison harnesses)
+    if temperature <= 0:
+        return {"do_sample": False}
+    return {"do_sample": True, "temperature": temperature, "top_p": top_p}
+
+CPU_PROFILES = ("fp32", "bf16", "int8")
+
+def inference_mode(fn):
+    """torch.inference_mode() as a decorator that only imports torch when fn runs."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        import torch
+        with torch.inference_mode():
+            return fn(*args, **kwargs)
+    return wrapper
+
+def cpu_supports_bf16() -> bool:
+    import torch
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+def configure_cpu_threads(num_threads: Optional[int] = None, num_interop_threads: Optional[int] = None):
+    import torch
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # only settable once, before any inter-op parallel work has started
+            print("Inter-op threads already fixed for this process; keeping", torch.get_num_interop_threads())
+
+_ST_DTYPES = {"F32": "float32", "F16": "float16", "BF16": "bfloat16", "I64": "int64", "I32": "int32",
+              "I16": "int16", "I8": "int8", "U8": "uint8", "BOOL": "bool", "F64": "float64"}
+
+def mmap_safetensors(path: str) -> Dict:
+    """
+    {name: tensor} backed by a private (copy-on-write) memory map of a .safetensors
+    file: nothing is read up front, pages are faulted in as layers touch them and
+    stay shared with the page cache until written.
+    """
+    import torch
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    base = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = getattr(torch, _ST_DTYPES[info["dtype"]])
+        start, end = info["data_offsets"]
+        if end == start:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        count = (end - start) // torch.tensor([], dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(mm, dtype=dtype, count=count, offset=base + start).reshape(info["shape"])
+    return tensors
+
+def load_mmap_model(weights_dir: str, dtype):
+    """
+    CPU model whose parameters ARE the mapped safetensors tensors (assign=True), or
+    None when that is not possible (no local safetensors, or stored dtype != dtype,
+    which would force a copy anyway).
+    """
+    import glob
+    files = sorted(glob.glob(os.path.join(weights_dir, "*.safetensors"))) if os.path.isdir(weights_dir) else []
+    if not files:
+        return None
+    state = {}
+    for path in files:
+        state.update(mmap_safetensors(path))
+    if any(t.is_floating_point() and t.dtype != dtype for t in state.values()):
+        return None
+
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+    config = AutoConfig.from_pretrained(weights_dir, trust_remote_code=True)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype, trust_remote_code=True)
+    missing, _ = model.load_state_dict(state, strict=False, assign=True)
+    model.tie_weights()
+    still_meta = [n for n, p in model.named_parameters() if p.is_meta]
+    if still_meta:
+        raise ValueError(f"{weights_dir}: no weights for {still_meta[:5]} (missing: {missing[:5]})")
+    if os.path.exists(os.path.join(weights_dir, "generation_config.json")):
+        from transformers import GenerationConfig
+        model.generation_config = GenerationConfig.from_pretrained(weights_dir)
+    return model
+
+def expand_cache(past, n: int):
+    """Repeat a legacy (key, value) cache n times along the batch dim as a fresh DynamicCache."""
+    from transformers import DynamicCache
+    return DynamicCache.from_legacy_cache(tuple(
+        (k.repeat(n, 1, 1, 1), v.repeat(n, 1, 1, 1)) for k, v in past
+    ))
+
+class FollowUpEngine:
+    """Long-lived tokenizer + model pair for one adapter dir (adapter_dir=None: bare base model)."""
+
+    def __init__(
+        self,
+        adapter_dir: Optional[str],
+        base_model: Optional[str] = None,
+        session_cache_mb: int = 512,
+        max_sessions: int = 64,
+        use_sys_prefix: bool = True,
+        early_stop: bool = True,
+        cpu_profile: str = "fp32",
+        num_threads: Optional[int] = None,
+        num_interop_threads: Optional[int] = None,
+        draft_model: Optional[str] = None,
+        draft_adapter_dir: Optional[str] = None,
+        draft_tokens: int = 5,
+        mmap_weights: bool = False
+    ):
+        import torch
+        from transformers import AutoTokenizer
+        if cpu_profile not in CPU_PROFILES:
+            raise ValueError(f"cpu_profile must be one of {CPU_PROFILES}, got {cpu_profile!r}")
+        t0 = time.perf_counter()
+        self.adapter_dir = adapter_dir
+        self.base_model = base_model or (detect_base_model(adapter_dir) if adapter_dir else DEFAULT_BASE_MODEL)
+        # LoRA already folded into the weights => no per-projection adapter matmuls
+        self.merged_dir = find_merged_model(adapter_dir) if adapter_dir and not base_model else None
+        weights = self.merged_dir or self.base_model
+        self.has_gpu = torch.cuda.is_available()
+        device_map = "auto" if self.has_gpu else {"": "cpu"}
+        if self.has_gpu:
+            self.cpu_profile = None
+            dtype = torch.float16
+        else:
+            configure_cpu_threads(num_threads, num_interop_threads)
+            if cpu_profile == "bf16" and not cpu_supports_bf16():
+                print("bf16 not supported by this CPU; falling back to fp32")
+                cpu_profile = "fp32"
+            self.cpu_profile = cpu_profile
+            dtype = torch.bfloat16 if cpu_profile == "bf16" else torch.float32
+
+        self.tok = AutoTokenizer.from_pretrained(weights, use_fast=True, trust_remote_code=True)
+        if self.tok.pad_token is None:
+            self.tok.pad_token = self.tok.eos_token
+        # decoder-only batching needs the prompts flush against the generated tokens
+        self.tok.padding_side = "left"
+
+        self.dtype, self.device_map = dtype, device_map
+        # CPU only: device_map="auto" placement needs from_pretrained
+        self.mmap_weights = mmap_weights and not self.has_gpu
+        self.model = self._load_model(weights, adapter_dir if not self.merged_dir else None)
+
+        # Draft for speculative decoding: proposes draft_tokens per step, self.model verifies
+        # them in one forward. Needs the same tokenizer (the Qwen2.5 sizes share one).
+        self.draft = None
+        self.draft_name = None
+        if draft_model or draft_adapter_dir:
+            draft_base = draft_model or detect_base_model(draft_adapter_dir)
+            draft_merged = find_merged_model(draft_adapter_dir) if draft_adapter_dir and not draft_model else None
+            self.draft = self._load_model(draft_merged or draft_base, draft_adapter_dir if not draft_merged else None)
+            if self.draft.config.vocab_size != self.model.config.vocab_size:
+                raise ValueError(f"draft {draft_base} and {self.base_model} do not share a vocabulary")
+            self.draft.generation_config.num_assistant_tokens = draft_tokens
+            # the default "heuristic" schedule writes its adapted length back into this config
+            # after every call; keep draft_tokens fixed so runs (and bench speculative) repeat
+            self.draft.generation_config.num_assistant_tokens_schedule = "constant"
+            self.draft_name = draft_merged or (f"{draft_base}+{draft_adapter_dir}" if draft_adapter_dir else draft_base)
+
+        # generate() is not re-entrant on a shared model; serialize callers
+        self.lock = threading.Lock()
+        self.sessions = SessionKVCache(max_bytes=session_cache_mb * 1024 * 1024, max_sessions=max_sessions)
+        self.use_sys_prefix = use_sys_prefix
+        self.early_stop = early_stop
+        self.last_new_tokens = 0
+        self.sys_prefix = self._encode_sys_prefix()
+        self.load_seconds = time.perf_counter() - t0
+        self.n_requests = 0
+        self.first_request_ms: Optional[float] = None
+        self.warm_ms: List[float] = []
+
+    def _load_model(self, weights: str, adapter_dir: Optional[str] = None):
+        import torch
+        from transformers import AutoModelForCausalLM
+        from peft import PeftModel
+        base = load_mmap_model(weights, self.dtype) if self.mmap_weights else None
+        if base is None:
+            base = AutoModelForCausalLM.from_pretrained(
+                weights,
+                torch_dtype=self.dtype,
+                device_map=self.device_map,
+                trust_remote_code=True,
+                low_cpu_mem_usage=True
+            )
+        model = PeftModel.from_pretrained(base, adapter_dir) if adapter_dir else base
+        model.eval()
+        if self.cpu_profile == "int8":
+            # fold LoRA first so the adapter deltas are quantized with the weights
+            if isinstance(model, PeftModel):
+                model = model.merge_and_unload()
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def make_prompt(self, messages: List[Dict[str,str]]) -> str:
+        if hasattr(self.tok, "apply_chat_template"):
+            return self.tok.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        # Fallback plain format (rarely used with Qwen)
+        lines = []
+        for m in messages:
+            role = m["role"].upper()
+            lines.append(f"{role}: {m['content']}")
+        lines.append("ASSISTANT: ")
+        return "\n".join(lines)
+
+    def build_prompt(self, history: List[Dict[str,str]]) -> str:
+        messages = [{"role":"system","content":SYS_MSG}] + map_roles_for_qwen(history)
+        return self.make_prompt(messages)
+
+    @inference_mode
+    def _encode_sys_prefix(self):
+        """(token ids, legacy cache) for the system block every prompt starts with."""
+        if hasattr(self.tok, "apply_chat_template"):
+            # the system turn alone, without the trailing generation prompt
+            text = self.tok.apply_chat_template(
+                [{"role":"system","content":SYS_MSG}], tokenize=False, add_generation_prompt=False
+            )
+        else:
+            text = f"SYSTEM: {SYS_MSG}"
+        input_ids = self._to_device(self.tok([text], return_tensors="pt"))["input_ids"]
+        past = self.model(input_ids=input_ids, use_cache=True).past_key_values
+        past = past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+        return input_ids[0].tolist(), past
+
+    def _stopping(self, prompt_len: int, *extra):
+        from transformers import StoppingCriteriaList
+        from .stopping import QuestionStop
+        criteria = list(extra)
+        if self.early_stop:
+            criteria.append(QuestionStop(self.tok, prompt_len))
+        return StoppingCriteriaList(criteria)
+
+    def _to_device(self, inputs):
+        if self.has_gpu:
+            return {k: v.cuda() for k, v in inputs.items()}
+        return dict(inputs)
+
+    @inference_mode
+    def generate(
+        self,
+        history: List[Dict[str,str]],
+        max_new_tokens=32,
+        temperature=0.8,
+        top_p=0.9,
+        session_id: Optional[str] = None
+    ) -> str:
+        t0 = time.perf_counter()
+        prompt = self.build_prompt(history)
+        inputs = self._to_device(self.tok([prompt], return_tensors="pt"))
+        gen_kwargs = dict(
+            max_new_tokens=max_new_tokens,
+            **sampling_kwargs(temperature, top_p),
+            eos_token_id=self.tok.eos_token_id,
+            pad_token_id=self.tok.eos_token_id,
+            stopping_criteria=self._stopping(inputs["input_ids"].shape[1])
+        )
+
+        with self.lock:
+            if self.draft is not None:
+                # assisted decoding prefills both models itself; session/sys-prefix KV is not used
+                out = self.model.generate(**inputs, assistant_model=self.draft, **gen_kwargs)
+            else:
+                prefix = self._prefill(inputs["input_ids"], session_id)
+                out = self.model.generate(**inputs, past_key_values=expand_cache(prefix, 1), **gen_kwargs)
+
+        # decode only the generated continuation, not the whole prompt
+        gen_ids = out[0][inputs["input_ids"].shape[1]:]
+        self.last_new_tokens = len(gen_ids)
+        question = postprocess(self.tok.decode(gen_ids, skip_special_tokens=True))
+        self._record(time.perf_counter() - t0)
+        return question
+
+    def stream(
+        self,
+        history: List[Dict[str,str]],
+        max_new_tokens=32,
+        temperature=0.8,
+        top_p=0.9,
+        session_id: Optional[str] = None
+    ) -> Iterator[str]:
+        """
+        Yield the follow-up question as text deltas while it decodes.
+        Decoding stops as soon as a '?' appears (postprocess would cut
+        there anyway); postprocess("".join(deltas)) gives the final question.
+        """
+        import torch
+        from transformers import TextIteratorStreamer
+        from .stopping import EventStop
+        t0 = time.perf_counter()
+        prompt = self.build_prompt(history)
+        inputs = self._to_device(self.tok([prompt], return_tensors="pt"))
+        streamer = TextIteratorStreamer(self.tok, skip_prompt=True, skip_special_tokens=True)
+        stop = threading.Event()
+        worker = None
+        drained = False
+        failure: List[BaseException] = []   # generate()'s exception, re-raised to the consumer
+
+        self.lock.acquire()
+        try:
+            if self.draft is not None:
+                start = {"assistant_model": self.draft}
+            else:
+                with torch.inference_mode():
+                    start = {"past_key_values": expand_cache(self._prefill(inputs["input_ids"], session_id), 1)}
+
+            def _worker():
+                try:
+                    with torch.inference_mode():
+                        self.model.generate(
+                            **inputs,
+                            **start,
+                            max_new_tokens=max_new_tokens,
+                            **sampling_kwargs(temperature, top_p),
+                            eos_token_id=self.tok.eos_token_id,
+                            pad_token_id=self.tok.eos_token_id,
+                            streamer=streamer,
+                            stopping_criteria=self._stopping(inputs["input_ids"].shape[1], EventStop(stop))
+                        )
+                except Exception as e:
+                    failure.append(e)
+                    streamer.end()   # unblock the consumer
+
+            worker = threading.Thread(target=_worker, name="fuq-stream", daemon=True)
+            worker.start()
+            for delta in streamer:
+                if stop.is_set():
+                    continue   # drain what was already queued
+                qpos = delta.find("?")
+                if qpos != -1:
+                    stop.set()
+                    delta = delta[:qpos+1]
+                if delta:
+                    yield delta
+            drained = True
+            worker.join()
+            if failure:
+                # an ended streamer looks like a finished decode; don't pass off a failure as a question
+                raise failure[0]
+        finally:
+            # also reached when the consumer abandons the generator
+            stop.set()
+            if worker is not None:
+                if not drained:
+                    for _ in streamer:
+                        pass
+                worker.join()
+            self.lock.release()
+            self._record(time.perf_counter() - t0)
+
+    # Left padding shifts every prompt by a different amount, so the batched
+    # path cannot start from the shared system prefix and prefills in full.
+    @inference_mode
+    def generate_batch(
+        self,
+        histories: List[List[Dict[str,str]]],
+        max_new_tokens=32,
+        temperature=0.8,
+        top_p=0.9,
+        raw: bool = False
+    ) -> List[str]:
+        """One left-padded generate() over several independent conversations.
+        raw=True returns the decoded continuations without postprocess (for format scoring)."""
+        t0 = time.perf_counter()
+        prompts = [self.build_prompt(h) for h in histories]
+        inputs = self._to_device(self.tok(prompts, return_tensors="pt", padding=True))
+
+        with self.lock:
+            out = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                **sampling_kwargs(temperature, top_p),
+                eos_token_id=self.tok.eos_token_id,
+                pad_token_id=self.tok.pad_token_id,
+                stopping_criteria=self._stopping(inputs["input_ids"].shape[1])
+            )
+
+        # left padding => every row's continuation starts at the same offset
+        prompt_len = inputs["input_ids"].shape[1]
+        texts = [self.tok.decode(row[prompt_len:], skip_special_tokens=True) for row in out]
+        questions = texts if raw else [postprocess(t) for t in texts]
+        elapsed = time.perf_counter() - t0
+        for _ in questions:
+            self._record(elapsed)
+        return questions
+
+    def _prefill(self, input_ids, session_id: Optional[str] = None):
+        """
+        Legacy (key, value) cache covering all but the last prompt token.
+        With a session_id, the longest token prefix already encoded for that
+        session is reused; otherwise the shared system-prompt prefix is.
+        Only the remaining tail is run through the model.
+        """
+        from transformers import DynamicCache
+        ids = input_ids[0].tolist()
+        target = len(ids) - 1
+        past, keep = None, 0
+        if session_id is not None:
+            entry = self.sessions.get(session_id)
+            if entry is not None:
+                cached_ids, cached_past = entry
+                keep = min(common_prefix_len(cached_ids, ids), target)
+                if keep > 0:
+                    past = crop_cache(cached_past, keep) if keep < len(cached_ids) else cached_past
+
+        if keep == 0 and self.use_sys_prefix and self.sys_prefix is not None:
+            sys_ids, sys_past = self.sys_prefix
+            if len(sys_ids) <= target and ids[:len(sys_ids)] == sys_ids:
+                past, keep = sys_past, len(sys_ids)
+
+        if keep < target:
+            out = self.model(
+                input_ids=input_ids[:, keep:target],
+                past_key_values=DynamicCache.from_legacy_cache(past) if past is not None else None,
+                use_cache=True
+            )
+            past = out.past_key_values
+            past = past.to_legacy_cache() if hasattr(past, "to_legacy_cache") else past
+
+        if session_id is not None:
+            self.sessions.record_prefill(keep, target - keep)
+            self.sessions.put(session_id, ids[:target], past)
+        return past
+
+    def end_session(self, session_id: str):
+        self.sessions.drop(session_id)
+
+    @inference_mode
+    def generate_candidates(
+        self,
+        history: List[Dict[str,str]],
+        n: int = 2,
+        max_new_tokens=32,
+        temperature=0.8,
+        top_p=0.9,
+        max_rounds: int = 3,
+        session_id: Optional[str] = None
+    ) -> List[str]:
+        """
+        Return up to n distinct follow-up questions.
+        The prompt is tokenized and prefilled once; every round samples only
+        as many sequences as there are still-empty slots, all starting from
+        the same cached prefix. Duplicates are detected via normalize_question.
+        With a session_id the prefix also reuses the session's earlier turns.
+        """
+        import torch
+        t0 = time.perf_counter()
+        prompt = self.build_prompt(history)
+        inputs = self._to_device(self.tok([prompt], return_tensors="pt"))
+        input_ids = inputs["input_ids"]
+        prompt_len = input_ids.shape[1]
+
+        kept: List[str] = []
+        seen = set()
+        with self.lock:
+            prefix = self._prefill(input_ids, session_id)
+            need = n
+            for _ in range(max_rounds):
+                out = self.model.generate(
+                    input_ids=input_ids.repeat(need, 1),
+                    attention_mask=torch.ones((need, prompt_len), dtype=torch.long, device=input_ids.device),
+                    past_key_values=expand_cache(prefix, need),
+                    max_new_tokens=max_new_tokens,
+                    **sampling_kwargs(temperature, top_p),
+                    eos_token_id=self.tok.eos_token_id,
+                    pad_token_id=self.tok.eos_token_id,
+                    stopping_criteria=self._stopping(prompt_len)
+                )
+                for row in out:
+                    q = postprocess(self.tok.decode(row[prompt_len:], skip_special_tokens=True))
+                    key = normalize_question(q)
+                    if key and key not in seen:
+                        seen.add(key)
+                        kept.append(q)
+                need = n - len(kept)
+                if need <= 0:
+                    break
+
+        self._record(time.perf_counter() - t0)
+        return kept[:n]
+
+    def _record(self, seconds: float):
+        ms = seconds * 1000.0
+        self.n_requests += 1
+        if self.first_request_ms is None:
+            self.first_request_ms = ms
+        else:
+            self.warm_ms.append(ms)
+            del self.warm_ms[:-1000]   # keep a bounded window
+
+    def latency_report(self) -> Dict:
+        import torch
+        warm = sorted(self.warm_ms)
+        return {
+            "adapter_dir": self.adapter_dir,
+            "base_model": self.base_model,
+            "merged_dir": self.merged_dir,
+            "draft": self.draft_name,
+            "mmap_weights": self.mmap_weights,
+            "cpu_profile": self.cpu_profile,
+            "threads": None if self.has_gpu else torch.get_num_threads(),
+            "requests": self.n_requests,
+            "load_s": round(self.load_seconds, 3),
+            # cold = what every call used to pay: full load + one generation
+            "cold_ms": round(self.load_seconds * 1000.0 + (self.first_request_ms or 0.0), 1),
+            "first_request_ms": None if self.first_request_ms is None else round(self.first_request_ms, 1),
+            "warm_mean_ms": round(sum(warm) / len(warm), 1) if warm else None,
+            "warm_p50_ms": round(warm[len(warm) // 2], 1) if warm else None,
+            "session_cache": self.sessions.stats(),
+        }
+
+_engines: Dict[tuple, FollowUpEngine] = {}
+_engines_lock = threading.Lock()
+
+def get_engine(adapter_dir: str, cpu_profile: str = "fp32", draft_model: Optional[str] = None,
+               draft_adapter_dir: Optional[str] = None, **kwargs) -> FollowUpEngine:
+    """Return the resident engine for exactly these settings, loading it on first use.
+    Every FollowUpEngine option is part of the key: a caller asking for e.g. another
+    session budget or mmap_weights gets its own engine, never one built differently."""
+    import inspect
+    # defaults filled in, so get_engine(d) and get_engine(d, mmap_weights=False) share one engine
+    bound = inspect.signature(FollowUpEngine.__init__).bind(
+        None, adapter_dir, cpu_profile=cpu_profile, draft_model=draft_model,
+        draft_adapter_dir=draft_adapter_dir, **kwargs)
+    bound.apply_defaults()
+    settings = dict(bound.arguments)
+    del settings["self"]
+    for path in ("adapter_dir", "draft_adapter_dir"):
+        if settings[path]:
+            settings[path] = os.path.abspath(settings[path])
+    key = tuple(sorted(settings.items()))
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = FollowUpEngine(adapter_dir, cpu_profile=cpu_profile, draft_model=draft_model,
+                                           draft_adapter_dir=draft_adapter_dir, **kwargs)
+        return _engines[key]
@@ -0,0 +1,170 @@
+# ============================================
+# Response cache in front of follow-up generation
+# - Exact tier: key = role-mapped history (map_roles_for_qwen) with each
+#   message normalized (case/punctuation/whitespace), so "Chest pain."
+#   and "chest pain" share one entry
+# - Optional similarity tier: in-process cosine index over embeddings of
+#   short histories (default: first patient turn only); a hit needs
+#   similarity >= threshold. Only the message content is embedded (no role
+#   prefixes shared by every entry), with the model's contextual last hidden
+#   state, so "chest pain" and "back pain" do not pool to nearly one vector.
+#   There is no default threshold: pick it from `python bench.py
+#   semantic-cache`, which measures the false-hit rate on the CSV's first turns
+# - TTL + LRU eviction by entry count; stats(): hit rate per tier
+#
+#   cache = ResponseCache(embed_fn=hidden_state_embedder(engine), similarity=0.98)
+#   question, tier = cache.get_or_generate(history, lambda: engine.generate(history))
+# ============================================
+
+import threading, time
+from collections import OrderedDict
+from typing import Callable, List, Dict, Optional, Tuple
+
+from .engine import map_roles_for_qwen, normalize_question
+
+def history_key(history: List[Dict[str,str]]) -> str:
+    return "\n".join(f"{m['role']}:{normalize_question(m['content'])}" for m in map_roles_for_qwen(history))
+
+def semantic_text(history: List[Dict[str,str]]) -> str:
+    """What the similarity tier embeds: the normalized message contents only."""
+    return "\n".join(normalize_question(m.get("content", "")) for m in history)
+
+def hidden_state_embedder(engine) -> Callable[[str], "torch.Tensor"]:
+    """Mean-pooled last hidden state of the engine's model over the text, L2-normalized."""
+    import torch
+
+    def embed(text: str):
+        ids = engine.tok(text, add_special_tokens=False, return_tensors="pt")["input_ids"]
+        ids = ids.cuda() if engine.has_gpu else ids
+        with engine.lock, torch.inference_mode():
+            hidden = engine.model(input_ids=ids, output_hidden_states=True, use_cache=False).hidden_states[-1]
+        return torch.nn.functional.normalize(hidden[0].float().mean(0), dim=0).cpu()
+    return embed
+
+def token_embedder(engine) -> Callable[[str], "torch.Tensor"]:
+    """Mean-pooled input-token embeddings (no forward pass). Context-free, so texts that share
+    most words score close to 1; kept as the baseline in bench.py semantic-cache."""
+    import torch
+    emb = engine.model.get_input_embeddings()
+
+    def embed(text: str):
+        ids = engine.tok(text, add_special_tokens=False, return_tensors="pt")["input_ids"].to(emb.weight.device)
+        with torch.inference_mode():
+            vec = emb(ids)[0].float().mean(0)
+        return torch.nn.functional.normalize(vec, dim=0).cpu()
+    return embed
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_s: Optional[float] = 3600.0,
+        embed_fn: Optional[Callable[[str], "torch.Tensor"]] = None,
+        similarity: Optional[float] = None,
+        semantic_max_messages: int = 1
+    ):
+        if embed_fn is not None and similarity is None:
+            raise ValueError("embed_fn needs an explicit similarity threshold (see bench.py semantic-cache)")
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.embed_fn = embed_fn
+        self.similarity = similarity
+        self.semantic_max_messages = semantic_max_messages
+        # key -> (question, stored_at, embedding or None)
+        self._entries: "OrderedDict[str, Tuple[str, float, object]]" = OrderedDict()
+        self._index = None   # (keys, stacked embeddings), rebuilt after any change
+        self.lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl_s is not None and time.monotonic() - stored_at > self.ttl_s
+
+    def _remove(self, key: str):
+        if self._entries.pop(key, None) is not None:
+            self._index = None
+
+    def _semantic_eligible(self, history: List[Dict[str,str]]) -> bool:
+        return self.embed_fn is not None and len(history) <= self.semantic_max_messages
+
+    def _nearest(self, vec) -> Optional[str]:
+        import torch
+        if self._index is None:
+            keys = [k for k, (_, _, v) in self._entries.items() if v is not None]
+            self._index = (keys, torch.stack([self._entries[k][2] for k in keys]) if keys else None)
+        keys, matrix = self._index
+        if matrix is None:
+            return None
+        scores = matrix @ vec
+        best = int(torch.argmax(scores))
+        return keys[best] if float(scores[best]) >= self.similarity else None
+
+    def _lookup(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry[1]):
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def get(self, history: List[Dict[str,str]]) -> Tuple[Optional[str], str]:
+        """(question, "exact" | "semantic") on a hit, (None, "miss") otherwise."""
+        key = history_key(history)
+        vec = self.embed_fn(semantic_text(history)) if self._semantic_eligible(history) else None
+        with self.lock:
+            question = self._lookup(key)
+            if question is not None:
+                self.exact_hits += 1
+                return question, "exact"
+            if vec is not None:
+                near = self._nearest(vec)
+                question = self._lookup(near) if near is not None else None
+                if question is not None:
+                    self.semantic_hits += 1
+                    return question, "semantic"
+            self.misses += 1
+            return None, "miss"
+
+    def put(self, history: List[Dict[str,str]], question: str):
+        key = history_key(history)
+        vec = self.embed_fn(semantic_text(history)) if self._semantic_eligible(history) else None
+        with self.lock:
+            self._remove(key)
+            self._entries[key] = (question, time.monotonic(), vec)
+            self._index = None
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_generate(self, history: List[Dict[str,str]], generate: Callable[[], str]) -> Tuple[str, str]:
+        question, tier = self.get(history)
+        if question is None:
+            question = generate()
+            self.put(history, question)
+        return question, tier
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self._index = None
+
+    def stats(self) -> Dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "semantic": self.embed_fn is not None,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,77 @@
+# ============================================
+# Per-session KV cache for multi-turn triage
+# - Keeps the encoded prompt (token ids + past_key_values) of each
+#   conversation so the next turn only prefills what is new
+# - LRU eviction by session, bounded by a byte budget and a session count
+# ============================================
+
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+def cache_nbytes(past) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past)
+
+def crop_cache(past, n: int):
+    """First n positions of a legacy (key, value) cache, as standalone tensors."""
+    return tuple((k[:, :, :n, :].contiguous(), v[:, :, :n, :].contiguous()) for k, v in past)
+
+def common_prefix_len(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+class SessionKVCache:
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, max_sessions: int = 64):
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self._entries: "OrderedDict[str, Tuple[List[int], tuple, int]]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    def get(self, session_id: str) -> Optional[Tuple[List[int], tuple]]:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(session_id)
+        return entry[0], entry[1]
+
+    def put(self, session_id: str, token_ids: List[int], past):
+        self.drop(session_id)
+        size = cache_nbytes(past)
+        if size > self.max_bytes:
+            return   # a single conversation larger than the budget is not worth pinning
+        self._entries[session_id] = (list(token_ids), past, size)
+        self.total_bytes += size
+        while self._entries and (self.total_bytes > self.max_bytes or len(self._entries) > self.max_sessions):
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.total_bytes -= evicted
+            self.evictions += 1
+
+    def drop(self, session_id: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def record_prefill(self, reused: int, prefilled: int):
+        self.reused_tokens += reused
+        self.prefilled_tokens += prefilled
+
+    def stats(self) -> Dict:
+        return {
+            "sessions": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "reused_tokens": self.reused_tokens,
+            "prefilled_tokens": self.prefilled_tokens,
+        }
@@ -0,0 +1,37 @@
+# ============================================
+# Stopping criteria for follow-up generation
+# - Kept out of engine.py so importing the engine does not pull in transformers
+# ============================================
+
+import re, threading
+
+import torch
+from transformers import StoppingCriteria
+
+class EventStop(StoppingCriteria):
+    """Stops generate() from another thread once `event` is set."""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+class QuestionStop(StoppingCriteria):
+    """
+    Per-sequence early stop: a row is done once its continuation holds a '?',
+    finishes a sentence, or exceeds max_words -- everything postprocess
+    would discard afterwards. Works row by row inside batched generate().
+    """
+
+    def __init__(self, tok, prompt_len: int, max_words: int = 20):
+        self.tok = tok
+        self.prompt_len = prompt_len
+        self.max_words = max_words
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = []
+        for row in input_ids[:, self.prompt_len:]:
+            text = self.tok.decode(row, skip_special_tokens=True)
+            done.append("?" in text or bool(re.search(r"[\.\!]\s", text)) or len(text.split()) > self.max_words)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,62 @@
+# ============================================
+# Merge a LoRA adapter into its base weights for inference
+# - PeftModel.merge_and_unload() folds every LoRA delta into the projections
+# - Saved as safetensors under <adapter_dir>/merged/ (+ tokenizer)
+# - Recorded in adapter_meta.json ("merged_dir", "merged_from" = adapter sha256)
+#   so FollowUpEngine loads it directly and skips PeftModel entirely
+#
+# Run:  python merge_adapter.py followuplora
+# ============================================
+
+import argparse, json, os, time
+from typing import Optional
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from peft import PeftModel
+
+from followup.engine import read_adapter_meta, detect_base_model, adapter_fingerprint
+
+MERGED_SUBDIR = "merged"
+
+def merge_adapter(adapter_dir: str, base_model: Optional[str] = None, out_subdir: str = MERGED_SUBDIR) -> str:
+    t0 = time.perf_counter()
+    base_model = base_model or detect_base_model(adapter_dir)
+    out_dir = os.path.join(adapter_dir, out_subdir)
+
+    print(f"Merging {adapter_dir} into {base_model}…")
+    # Merge in fp32 on CPU: exact deltas, and it works on the triage boxes too
+    base = AutoModelForCausalLM.from_pretrained(
+        base_model,
+        torch_dtype=torch.float32,
+        device_map={"": "cpu"},
+        trust_remote_code=True,
+        low_cpu_mem_usage=True
+    )
+    merged = PeftModel.from_pretrained(base, adapter_dir).merge_and_unload()
+    merged.save_pretrained(out_dir, safe_serialization=True)
+
+    tok = AutoTokenizer.from_pretrained(base_model, use_fast=True, trust_remote_code=True)
+    tok.save_pretrained(out_dir)
+
+    meta = read_adapter_meta(adapter_dir)
+    meta.update({
+        "base_model": base_model,
+        "merged_dir": out_subdir,
+        "merged_from": adapter_fingerprint(adapter_dir),
+    })
+    with open(os.path.join(adapter_dir, "adapter_meta.json"), "w", encoding="utf-8") as w:
+        json.dump(meta, w, ensure_ascii=False, indent=2)
+
+    print(f"Merged model saved to: {out_dir} ({time.perf_counter() - t0:.1f}s)")
+    return out_dir
+
+def main():
+    ap = argparse.ArgumentParser(description="Merge a LoRA adapter into its base model (safetensors).")
+    ap.add_argument("adapter_dir", nargs="?", default="followuplora")
+    ap.add_argument("--base-model", default=None, help="defaults to adapter_meta.json's base_model")
+    args = ap.parse_args()
+    merge_adapter(args.adapter_dir, base_model=args.base_model)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# ============================================
+# Follow-up Question Server (local HTTP/JSON)
+# - Keeps one resident FollowUpEngine per adapter dir
+# - POST /v1/next-question  {"history": [{"role": "patient", "content": "..."}],
+#                             "session_id": "optional, reuses the conversation's KV cache"}
+#       -> {"question": "...", "latency_ms": 123.4}
+# - POST /v1/next-question/stream  (same body) -> text/event-stream:
+#       data: {"delta": "..."}  ...  then  event: done / data: {"question", "ttft_ms", "latency_ms"}
+#       (or event: error / data: {"error"} if generation fails mid-stream)
+# - Malformed bodies get 400 {"error"}; a failed generation gets 500 {"error"}
+# - GET  /v1/health         -> engine load time + cold/warm latency
+#                              (+ batcher queue depth / batch fill, response-cache hit rate)
+# - --response-cache: repeated (normalized) histories are answered from memory,
+#   "cache": "exact" | "semantic" | "miss" in every reply; --semantic-cache adds
+#   the embedding-similarity tier for first turns
+#
+# Run:  python serve.py --adapter-dir followuplora --port 8765
+# Concurrent clinicians:  add --max-batch-size 8 --max-wait-ms 20
+#   (batched requests share the server's sampling settings)
+# ============================================
+
+import argparse, json, time, traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from followup.engine import get_engine, FollowUpEngine, CPU_PROFILES, postprocess
+from followup.batching import MicroBatchScheduler
+from followup.response_cache import ResponseCache, hidden_state_embedder
+
+ADAPTER_DIR = "followuplora"
+
+class FollowUpHandler(BaseHTTPRequestHandler):
+    engine: Optional[FollowUpEngine] = None
+    scheduler: Optional[MicroBatchScheduler] = None
+    cache: Optional[ResponseCache] = None
+
+    def _send_json(self, status: int, payload: Dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        # the Flutter app (web build included) calls us directly
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        return json.loads(raw.decode("utf-8"))
+
+    @staticmethod
+    def _parse_request(req) -> Tuple[List[Dict[str,str]], Dict]:
+        """Validated (history, generation kwargs); ValueError with a client-facing message otherwise."""
+        if not isinstance(req, dict):
+            raise ValueError("request body must be a JSON object")
+        history = req.get("history")
+        if not isinstance(history, list) or not history:
+            raise ValueError("'history' must be a non-empty list of {role, content}")
+        for i, m in enumerate(history):
+            if not isinstance(m, dict) or not isinstance(m.get("role"), str) or not isinstance(m.get("content"), str):
+                raise ValueError(f"history[{i}] must be an object with string 'role' and 'content'")
+        session_id = req.get("session_id")
+        if session_id is not None and not isinstance(session_id, str):
+            raise ValueError("'session_id' must be a string")
+        try:
+            params = dict(
+                max_new_tokens=int(req.get("max_new_tokens", 32)),
+                temperature=float(req.get("temperature", 0.8)),
+                top_p=float(req.get("top_p", 0.9)),
+                session_id=session_id,
+            )
+        except (TypeError, ValueError):
+            raise ValueError("'max_new_tokens' must be an integer, 'temperature' and 'top_p' numbers")
+        if params["max_new_tokens"] <= 0:
+            raise ValueError("'max_new_tokens' must be positive")
+        return history, params
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == "/v1/health":
+            payload = {"status": "ok", **self.engine.latency_report()}
+            if self.scheduler is not None:
+                payload["batching"] = self.scheduler.metrics()
+            if self.cache is not None:
+                payload["response_cache"] = self.cache.stats()
+            self._send_json(200, payload)
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def _send_event(self, payload: Dict, event: Optional[str] = None):
+        chunk = (f"event: {event}\n" if event else "") + f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        self.wfile.write(chunk.encode("utf-8"))
+        self.wfile.flush()
+
+    def do_POST(self):
+        if self.path not in ("/v1/next-question", "/v1/next-question/stream"):
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            history, params = self._parse_request(self._read_json())   # JSONDecodeError is a ValueError
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        if self.path.endswith("/stream"):
+            self._stream(history, params)
+            return
+
+        t0 = time.perf_counter()
+        def _generate() -> str:
+            if self.scheduler is not None:
+                return self.scheduler.submit_threadsafe(history)
+            return self.engine.generate(history, **params)
+
+        payload = {}
+        try:
+            if self.cache is not None:
+                question, payload["cache"] = self.cache.get_or_generate(history, _generate)
+            else:
+                question = _generate()
+        except Exception as e:
+            # answer instead of dropping the connection; the traceback stays in the server log
+            self.log_error("generation failed: %r", e)
+            traceback.print_exc()
+            self._send_json(500, {"error": f"generation failed: {type(e).__name__}"})
+            return
+        self._send_json(200, {
+            "question": question,
+            "latency_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+            **payload,
+        })
+
+    def _stream(self, history: List[Dict[str,str]], params: Dict):
+        # streaming is per request, so it bypasses the micro-batcher
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+
+        t0 = time.perf_counter()
+        ttft_ms = None
+        parts: List[str] = []
+        try:
+            cached, tier = self.cache.get(history) if self.cache is not None else (None, None)
+            if cached is not None:
+                # whole question at once; same event shape as a decoded stream
+                ms = round((time.perf_counter() - t0) * 1000.0, 1)
+                self._send_event({"delta": cached})
+                self._send_event({"question": cached, "ttft_ms": ms, "latency_ms": ms, "cache": tier}, event="done")
+                return
+            for delta in self.engine.stream(history, **params):
+                if ttft_ms is None:
+                    ttft_ms = round((time.perf_counter() - t0) * 1000.0, 1)
+                parts.append(delta)
+                self._send_event({"delta": delta})
+            question = postprocess("".join(parts))
+            if self.cache is not None:
+                self.cache.put(history, question)
+            self._send_event({
+                "question": question,
+                "ttft_ms": ttft_ms,
+                "latency_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+                **({"cache": tier} if self.cache is not None else {}),
+            }, event="done")
+        except (BrokenPipeError, ConnectionResetError):
+            pass   # client went away; closing the generator stops decoding
+        except Exception as e:
+            # the 200 is already sent: report the failure as a terminal SSE event
+            self.log_error("stream failed: %r", e)
+            traceback.print_exc()
+            try:
+                self._send_event({"error": f"generation failed: {type(e).__name__}"}, event="error")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+def main():
+    ap = argparse.ArgumentParser(description="Serve follow-up questions over local HTTP/JSON.")
+    ap.add_argument("--adapter-dir", default=ADAPTER_DIR)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--max-batch-size", type=int, default=1,
+                    help="> 1 enables micro-batching of concurrent requests")
+    ap.add_argument("--max-wait-ms", type=float, default=20.0,
+                    help="how long the batcher holds the first request waiting for company")
+    ap.add_argument("--cpu-profile", choices=CPU_PROFILES, default="fp32",
+                    help="CPU-only: int8 dynamic quantization or bf16 instead of fp32")
+    ap.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    ap.add_argument("--interop-threads", type=int, default=None, help="torch inter-op threads")
+    ap.add_argument("--mmap-weights", action="store_true",
+                    help="CPU: memory-map the merged safetensors export instead of reading it in")
+    ap.add_argument("--response-cache", type=int, default=0, metavar="ENTRIES",
+                    help="> 0 answers repeated histories from an LRU cache of this many entries")
+    ap.add_argument("--cache-ttl", type=float, default=3600.0, help="response-cache entry lifetime (s)")
+    ap.add_argument("--semantic-cache", type=float, default=None, metavar="SIMILARITY",
+                    help="also match first turns by hidden-state cosine similarity >= this "
+                         "(pick it with `bench.py semantic-cache`)")
+    args = ap.parse_args()
+
+    # Load before accepting traffic so the first clinician doesn't pay for it
+    engine = get_engine(
+        args.adapter_dir,
+        cpu_profile=args.cpu_profile,
+        num_threads=args.threads,
+        num_interop_threads=args.interop_threads,
+        mmap_weights=args.mmap_weights,
+    )
+    FollowUpHandler.engine = engine
+    print(f"Loaded {engine.base_model} + {args.adapter_dir} in {engine.load_seconds:.1f}s")
+    if args.max_batch_size > 1:
+        FollowUpHandler.scheduler = MicroBatchScheduler(
+            engine, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms
+        )
+        FollowUpHandler.scheduler.start_in_thread()
+        print(f"Micro-batching on: up to {args.max_batch_size} requests / {args.max_wait_ms:.0f} ms window")
+    if args.response_cache > 0:
+        FollowUpHandler.cache = ResponseCache(
+            max_entries=args.response_cache,
+            ttl_s=args.cache_ttl,
+            embed_fn=hidden_state_embedder(engine) if args.semantic_cache is not None else None,
+            similarity=args.semantic_cache,
+        )
+        print(f"Response cache on: {args.response_cache} entries, ttl {args.cache_ttl:.0f}s"
+              + (f", semantic ≥ {args.semantic_cache}" if args.semantic_cache is not None else ""))
+
+    server = ThreadingHTTPServer((args.host, args.port), FollowUpHandler)
+    print(f"Serving on http://{args.host}:{args.port}  (POST /v1/next-question[/stream], GET /v1/health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down.")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+# ============================================
+# Trainer hooks for training.py
+# - AsyncAdapterCheckpoint: adapter-only checkpoints written off-thread
+# - ThroughputMetrics + TimedSFTTrainer: per-step throughput/timing JSONL
+#   and an opt-in torch.profiler window
+# Imported by trainLoraSft only, so `import training` does not load trl.
+# ============================================
+
+import os, json, random, time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import TrainerCallback
+from trl import SFTTrainer
+
+hasGpu = torch.cuda.is_available()
+
+RUN_KEY_FILE = "run_key.json"   # which run wrote a checkpoint (see training.runFingerprint)
+
+def checkpointRunKey(ckptDir: str) -> Optional[str]:
+    p = os.path.join(ckptDir, RUN_KEY_FILE)
+    if not os.path.exists(p):
+        return None
+    with open(p, "r", encoding="utf-8") as f:
+        return json.load(f).get("runKey")
+
+def listCheckpoints(parent: str) -> List[Tuple[int, str]]:
+    """(step, path) of every complete checkpoint-<step> dir in parent, oldest first."""
+    if not os.path.isdir(parent):
+        return []
+    found = [(int(d.split("-")[1]), os.path.join(parent, d)) for d in os.listdir(parent)
+             if d.startswith("checkpoint-") and d.split("-")[1].isdigit()]
+    return sorted(found)
+
+def snapshotToCpu(obj):
+    """Deep copy of a (nested) state dict with every tensor cloned to CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshotToCpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshotToCpu(v) for v in obj)
+    return obj
+
+class AsyncAdapterCheckpoint(TrainerCallback):
+    """Adapter-only checkpoints in the Trainer's checkpoint-<step> layout, written off-thread.
+
+    At a save point only the LoRA weights, the (LoRA-only) optimizer/scheduler state, the RNG
+    state and trainer_state.json are copied to CPU; a single writer thread serializes them into
+    a temp dir that is renamed into place, so a checkpoint-* dir is always complete and
+    `trainer.train(resume_from_checkpoint=...)` can load it. Base weights are never written.
+    `runKey` (data + base model + hyperparameters, see training.runFingerprint) is stored as
+    run_key.json so a later run only resumes a checkpoint of the same configuration; pruning
+    to `keep` only ever removes checkpoints carrying this runKey.
+    """
+    def __init__(self, outDir: str, everySteps: Optional[int] = None,
+                 everySeconds: Optional[float] = None, keep: int = 2, runKey: Optional[str] = None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.outDir = outDir
+        self.everySteps = everySteps
+        self.everySeconds = everySeconds
+        self.keep = keep
+        self.runKey = runKey
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ckpt")
+        self.pending = None
+        self.lastSave = time.monotonic()
+
+    def _due(self, step: int) -> bool:
+        if self.everySteps and step % self.everySteps == 0:
+            return True
+        return bool(self.everySeconds) and time.monotonic() - self.lastSave >= self.everySeconds
+
+    def on_step_end(self, args, state, control, model=None, optimizer=None, lr_scheduler=None, **kwargs):
+        # Called after optimizer.step()/scheduler.step() and global_step += 1: state is consistent
+        if not state.is_world_process_zero or not self._due(state.global_step):
+            return
+        if self.pending is not None and not self.pending.done():
+            print(f"[ckpt] step {state.global_step}: previous checkpoint still writing, skipped")
+            return
+        import dataclasses
+        import numpy as np
+        from peft import get_peft_model_state_dict
+        # numpy's key as a list: Trainer._load_rng_state uses torch.load, which on torch >= 2.6 is
+        # weights_only and refuses pickled ndarrays; np.random.set_state accepts the list as is
+        npName, npKey, npPos, npHasGauss, npGauss = np.random.get_state()
+        rng = {"python": random.getstate(),
+               "numpy": (npName, npKey.tolist(), int(npPos), int(npHasGauss), float(npGauss)),
+               "cpu": torch.random.get_rng_state()}
+        if hasGpu:
+            rng["cuda"] = torch.cuda.random.get_rng_state_all() if args.world_size > 1 else torch.cuda.random.get_rng_state()
+        snap = {
+            "step": state.global_step,
+            "adapter": snapshotToCpu(get_peft_model_state_dict(model)),
+            "peftConfig": model.peft_config[model.active_adapter],
+            "optimizer": snapshotToCpu(optimizer.state_dict()),
+            "scheduler": snapshotToCpu(lr_scheduler.state_dict()),
+            "rng": rng,
+            "rngName": f"rng_state_{args.process_index}.pth" if args.world_size > 1 else "rng_state.pth",
+            "state": json.dumps(dataclasses.asdict(state), indent=2, sort_keys=True) + "\n",
+        }
+        self.lastSave = time.monotonic()
+        self.pending = self.pool.submit(self._write, snap)
+
+    def _write(self, snap: Dict):
+        import shutil
+        from safetensors.torch import save_file
+        t0 = time.perf_counter()
+        final = os.path.join(self.outDir, f"checkpoint-{snap['step']}")
+        tmp = os.path.join(self.outDir, f".tmp-checkpoint-{snap['step']}")
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        save_file(snap["adapter"], os.path.join(tmp, "adapter_model.safetensors"), metadata={"format": "pt"})
+        snap["peftConfig"].save_pretrained(tmp)
+        torch.save(snap["optimizer"], os.path.join(tmp, "optimizer.pt"))
+        torch.save(snap["scheduler"], os.path.join(tmp, "scheduler.pt"))
+        torch.save(snap["rng"], os.path.join(tmp, snap["rngName"]))
+        with open(os.path.join(tmp, "trainer_state.json"), "w", encoding="utf-8") as w:
+            w.write(snap["state"])
+        with open(os.path.join(tmp, RUN_KEY_FILE), "w", encoding="utf-8") as w:
+            json.dump({"runKey": self.runKey}, w)
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(tmp, final)
+
+        ours = [path for _, path in listCheckpoints(self.outDir) if checkpointRunKey(path) == self.runKey]
+        for old in ours[:-self.keep] if self.keep else []:
+            shutil.rmtree(old, ignore_errors=True)
+        print(f"[ckpt] saved {final} ({time.perf_counter() - t0:.1f}s, in background)")
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.pending is not None:
+            self.pending.result()   # surface write errors; never exit with a half-written dir
+        self.pool.shutdown(wait=True)
+
+def peakMemoryBytes() -> int:
+    """Peak VRAM since the last reset (GPU) or peak RSS of this process so far (CPU)."""
+    if hasGpu:
+        return torch.cuda.max_memory_allocated()
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024   # KiB on Linux
+
+class ThroughputMetrics(TrainerCallback):
+    """One JSON line per optimizer step in <outDir>/<fileName>: tokens/sec, step time split into
+    data / forward / backward / optimizer, packing efficiency (real tokens / batch slots) and
+    peak memory.
+
+    forward = the model's own forward (hooks on the top-level module); backward = the rest of
+    Trainer.training_step; optimizer = clip + step + scheduler + zero_grad; data = everything
+    between micro-steps (dataloader fetch, collation, logging). On GPU each boundary
+    synchronizes, so the split is exact at a small throughput cost.
+    `profileSteps=(start, n)` also records steps start..start+n-1 with torch.profiler
+    (Chrome trace in <outDir>/profile/, top ops printed).
+    """
+    def __init__(self, outDir: str, fileName: str = "train_metrics.jsonl", profileSteps=None):
+        self.outDir = outDir
+        self.path = os.path.join(outDir, fileName)
+        self.profileSteps = profileSteps
+        self.prof = None
+        self.file = None
+        self.hooks = []
+        self._reset()
+
+    def _reset(self):
+        self.secs = {"data": 0.0, "forward": 0.0, "backward": 0.0, "optimizer": 0.0}
+        self.tokens = 0
+        self.slots = 0
+
+    @staticmethod
+    def _now() -> float:
+        if hasGpu:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _fwdStart(self, module, inputs):
+        self.fwdT0 = self._now()
+
+    def _fwdEnd(self, module, inputs, output):
+        self.fwdSecs += self._now() - self.fwdT0
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        self.hooks = [model.register_forward_pre_hook(self._fwdStart), model.register_forward_hook(self._fwdEnd)]
+        if state.is_world_process_zero:
+            os.makedirs(self.outDir, exist_ok=True)
+            self.file = open(self.path, "a", encoding="utf-8")
+        if hasGpu:
+            torch.cuda.reset_peak_memory_stats()
+        self.mark = self._now()
+
+    def beginMicroStep(self, inputs):
+        now = self._now()
+        self.secs["data"] += now - self.mark
+        self.microT0, self.fwdSecs = now, 0.0
+        ids, mask = inputs["input_ids"], inputs.get("attention_mask")
+        self.slots += ids.numel()
+        self.tokens += int(mask.sum()) if mask is not None else ids.numel()
+
+    def endMicroStep(self):
+        now = self._now()
+        self.secs["forward"] += self.fwdSecs
+        self.secs["backward"] += now - self.microT0 - self.fwdSecs
+        self.mark = now
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        if self.profileSteps and state.global_step == self.profileSteps[0] and self.prof is None:
+            from torch.profiler import profile, ProfilerActivity
+            acts = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if hasGpu else [])
+            self.prof = profile(activities=acts, record_shapes=True, profile_memory=True)
+            self.prof.__enter__()
+            print(f"[profile] capturing steps {self.profileSteps[0]}–{sum(self.profileSteps) - 1}")
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = self._now()
+        self.secs["optimizer"] += now - self.mark
+        stepSecs = sum(self.secs.values())
+        if self.file is not None:
+            rec = {
+                "step": state.global_step,
+                "tokens": self.tokens,
+                "tokens_per_sec": round(self.tokens / stepSecs, 1) if stepSecs else None,
+                "global_tokens_per_sec": round(self.tokens * args.world_size / stepSecs, 1) if stepSecs else None,
+                "step_s": round(stepSecs, 4),
+                **{f"{k}_s": round(v, 4) for k, v in self.secs.items()},
+                "packing_efficiency": round(self.tokens / self.slots, 4) if self.slots else None,
+                "peak_mem_bytes": peakMemoryBytes(),
+            }
+            self.file.write(json.dumps(rec) + "\n")
+            self.file.flush()
+        if self.prof is not None and state.global_step >= sum(self.profileSteps):
+            self._stopProfiler()
+        self._reset()
+        self.mark = self._now()
+
+    def _stopProfiler(self):
+        self.prof.__exit__(None, None, None)
+        traceDir = os.path.join(self.outDir, "profile")
+        os.makedirs(traceDir, exist_ok=True)
+        rank = int(os.environ.get("RANK", 0))
+        self.prof.export_chrome_trace(os.path.join(traceDir, f"trace-rank{rank}.json"))
+        sortKey = "self_cuda_time_total" if hasGpu else "self_cpu_time_total"
+        print(self.prof.key_averages().table(sort_by=sortKey, row_limit=15))
+        print(f"[profile] trace written to {traceDir}")
+        self.prof = None
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.prof is not None:
+            self._stopProfiler()
+        for h in self.hooks:
+            h.remove()
+        self.hooks = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        print(f"[metrics] per-step throughput in {self.path}")
+
+class TimedSFTTrainer(SFTTrainer):
+    """SFTTrainer whose training_step (forward + backward of one micro-batch) reports to ThroughputMetrics."""
+    def __init__(self, *args, metrics: Optional[ThroughputMetrics] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+        if metrics is not None:
+            self.add_callback(metrics)
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        if self.metrics is None:
+            return super().training_step(model, inputs, *args, **kwargs)
+        self.metrics.beginMicroStep(inputs)
+        loss = super().training_step(model, inputs, *args, **kwargs)
+        self.metrics.endMicroStep()
+        return loss
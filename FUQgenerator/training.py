@@ -1,21 +1,27 @@
 # ============================================================
 # Follow-up Question Generator — LoRA SFT (No bitsandbytes/triton)
-# One-cell Colab script for FREE tier CPU/GPU. Just run this cell.
+# Training script for FREE tier Colab CPU/GPU. Needs the rest of FUQgenerator/
+# next to it (dataprep.py, train_callbacks.py, merge_adapter.py, followup/):
+# upload/clone the folder, then `python training.py` from inside it (in a
+# notebook: %cd FUQgenerator, then !python training.py).
 #
 # Expects your CSV at: /content/conversation_data.csv  (header allowed)
 # Columns (flexible): id, patient, doctor   (also accepts Patient_Answer/user & Doctor_response/assistant)
 # Saves model adapter to: /content/followup-lora
 # ============================================================
 
-import os, sys, csv, json, subprocess
-from typing import List, Dict, Tuple
-from collections import defaultdict
+import os, sys, gc, json, glob, hashlib, random, subprocess, time
+from typing import List, Dict, Optional
 
 # -----------------------
 # User-editable settings:
 # -----------------------
-dataPath = "/content/conversation_data.csv"   # <-- upload your CSV here (header allowed)
+dataPath = "/content/conversation_data.csv"   # <-- upload your CSV here (header allowed); a glob
+                                              #     like "/content/wards/*.csv" merges every export
+csvSortedById = True                          # rows of one conversation are contiguous (fast path;
+                                              #     raises if an ID reappears later — set False then)
 outputDir = "/content/followup-lora"          # <-- artifacts will be saved here
+cacheDir  = "/content/fuq-cache"              # prepared JSONL + tokenized/packed datasets (None = off)
 
 # Small models only (safe for free Colab):
 candidateBaseModels = [
@@ -32,9 +38,27 @@ lr              = 1e-4
 loraR           = 8
 loraAlpha       = 16
 loraDropout     = 0.05
-saveSteps       = 999_999   # disable frequent checkpointing
+saveSteps       = 200       # adapter-only checkpoint every N optimizer steps (written in the background)
+saveMinutes     = 15        # ...and/or at least this often by wall clock (None = steps only)
+saveKeep        = 2         # newest checkpoint-* dirs kept in outputDir
+resumeTraining  = True      # main(): continue from the newest checkpoint in outputDir if any
+metricsFile     = "train_metrics.jsonl"   # per-step throughput/timing/memory records in outputDir
+profileSteps    = None      # e.g. (20, 3): torch.profiler trace of steps 20–22 → outputDir/profile/
+draftModel      = None      # e.g. "Qwen/Qwen2.5-0.5B-Instruct": speculative decoding for the sanity generation
+draftAdapterDir = None      # optional LoRA (or merged export) for the draft model
 loggingSteps    = 50
 seed            = 42
+pairParams      = dict(maxTurnsPerExample=40, maxHistoryTurns=8, minQuestionLen=3,
+                       heldoutFrac=0.05)   # conversations kept out of training for evaluation.py --csv
+batchMode       = "pack"    # "pack": concat into maxSeqLen blocks | "bucket": trim to tokenBudget, group by length
+tokenBudget     = None      # bucket mode: max tokens per example (None = maxSeqLen); oldest turns are dropped
+memHeadroom     = 1.6       # probe: weights × this must fit in free RAM/VRAM (activations, LoRA state)
+mergeAfterTrain = True      # also export base+adapter merged (faster inference)
+autoTuneBatch   = True      # calibrate batch/accum/seq length on this device before training
+calibBatchSizes = [1, 2, 4, 8]      # per-device batches tried (only divisors of the effective batch)
+calibSeqLens    = [768, 1024]       # pack lengths tried (bucket mode calibrates at tokenBudget only)
+calibSteps      = 3         # timed forward/backward steps per config (after one warm-up)
+cpuProcs        = 1         # >1 (CPU only): LoRA SFT over this many local processes, torch DDP on gloo
 
 # --------------------------------
 # 1) Minimal dependency installer
@@ -42,108 +66,27 @@ seed            = 42
 def pipInstall(pkgs: List[str]):
     subprocess.check_call([sys.executable, "-m", "pip", "install", "-q"] + pkgs)
 
-print("Installing/confirming dependencies (few mins on first run)…")
-pipInstall([
-    "transformers==4.44.2",
-    "datasets==2.20.0",
-    "accelerate==0.34.2",
-    "peft==0.12.0",
-    "trl==0.10.1"
-])
+def ensureDependencies():
+    print("Installing/confirming dependencies (few mins on first run)…")
+    pipInstall([
+        "transformers==4.44.2",
+        "datasets==2.20.0",
+        "accelerate==0.34.2",
+        "peft==0.12.0",
+        "trl==0.10.1"
+    ])
+
+# Only when run as the script (`python training.py`): importing training has no side effects.
+# DDP workers (LOCAL_RANK set by torch.distributed.run) reuse the launcher's install.
+if __name__ == "__main__" and "LOCAL_RANK" not in os.environ:
+    ensureDependencies()
 
 # -------------------------------
 # 2) Data: CSV → SFT chat pairs
 # -------------------------------
-def loadConvosFromCsv(csvPath: str) -> Dict[str, List[Tuple[str, str]]]:
-    if not os.path.exists(csvPath):
-        raise FileNotFoundError(f"CSV/TSV not found at {csvPath}")
-
-    def pick(row, keys, default=""):
-        for k in keys:
-            if k in row and row[k] is not None:
-                return str(row[k])
-        return default
-
-    byId = defaultdict(list)
-    n_rows = 0
-    n_kept = 0
-
-    with open(csvPath, "r", encoding="utf-8", newline="") as f:
-        # --- Detect delimiter (tab vs comma) and header ---
-        sample = f.read(4096)
-        f.seek(0)
-        try:
-            dialect = csv.Sniffer().sniff(sample, delimiters=",\t;|")
-            has_header = csv.Sniffer().has_header(sample)
-        except Exception:
-            dialect = csv.get_dialect("excel")
-            dialect.delimiter = "\t" if "\t" in sample else ","
-            has_header = True
-
-        if has_header:
-            reader = csv.DictReader(f, dialect=dialect)
-            for row in reader:
-                n_rows += 1
-                rid     = pick(row, ["id","ID","Id"]).strip()
-                patient = pick(row, ["patient","Patient","Patient_Answer","user","customer"]).strip()
-                doctor  = pick(row, ["doctor","Doctor","Doctor_response","assistant","question"]).strip()
-                if rid and (patient or doctor):
-                    byId[rid].append((patient, doctor))
-                    n_kept += 1
-        else:
-            reader = csv.reader(f, dialect=dialect)
-            for row in reader:
-                n_rows += 1
-                if not row or len(row) < 3: continue
-                rid     = (row[0] or "").strip()
-                patient = (row[1] or "").strip()
-                doctor  = (row[2] or "").strip()
-                if rid and (patient or doctor):
-                    byId[rid].append((patient, doctor))
-                    n_kept += 1
-
-    print(f"[CSV] rows read: {n_rows}, kept: {n_kept}, conversations: {len(byId)}")
-    return byId
-
-def buildSftPairs(
-    byId: Dict[str, List[Tuple[str, str]]],
-    maxTurnsPerExample: int = 40,
-    maxHistoryTurns: int = 8,
-    minQuestionLen: int = 3
-) -> List[Dict]:
-    pairs = []
-    sysMsg = (
-        "You are a clinical assistant. Output ONLY the next, single best follow-up question to the patient. "
-        "Keep it concise (max 20 words). Do not provide diagnoses, reassurance, or instructions; ask a question. "
-        "End the sentence with a question mark."
-    )
-    for _, turns in byId.items():
-        running = []
-        used = 0
-        for (patientUtterance, doctorQuestion) in turns:
-            if patientUtterance:
-                running.append({"role": "patient", "content": patientUtterance})
-
-            if doctorQuestion:
-                dq = doctorQuestion.strip()
-                if len(dq) >= minQuestionLen and ("?" in dq or dq.endswith("?")):
-                    trimmed = running[-maxHistoryTurns:] if maxHistoryTurns > 0 else running
-                    messages = [{"role": "system", "content": sysMsg}] + trimmed + [
-                        {"role": "assistant", "content": dq}
-                    ]
-                    pairs.append({"messages": messages})
-                    used += 1
-                    if maxTurnsPerExample > 0 and used >= maxTurnsPerExample:
-                        break
-                # append as a 'doctor' role to history for context drift
-                running.append({"role": "doctor", "content": doctorQuestion})
-    return pairs
-
-def saveJsonl(pairs: List[Dict], outPath: str):
-    os.makedirs(os.path.dirname(outPath), exist_ok=True)
-    with open(outPath, "w", encoding="utf-8") as w:
-        for ex in pairs:
-            w.write(json.dumps(ex, ensure_ascii=False) + "\n")
+# Streaming pipeline lives in dataprep.py (rows → conversations → pairs → JSONL)
+from dataprep import loadConvosFromCsv, buildSftPairs, saveJsonl, prepareSftJsonl, prepareManyCsv, sftSysMsg
+from dataprep import chatTemplateRoles, trimToTokenBudget, lengthGroupedBatches, paddingEfficiency
 
 # -------------------------------
 # 3) Dataset (HF datasets)
@@ -156,12 +99,105 @@ def buildDataset(jsonlPath: str, seed: int = 42, splitTrain: float = 0.95):
         return ds["train"], ds["test"]
     return ds, None
 
+# Content-hashed cache: identical inputs → identical key → skip the work.
+def hashFiles(paths: List[str]) -> str:
+    h = hashlib.sha256()
+    for p in sorted(paths):
+        h.update(os.path.basename(p).encode("utf-8"))
+        with open(p, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+def cacheKey(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:20]
+
+def tokenizerFingerprint(tok) -> str:
+    # full serialized vocab/merges/normalizer for fast tokenizers, plus the chat template
+    body = tok.backend_tokenizer.to_str() if getattr(tok, "is_fast", False) else json.dumps(tok.get_vocab(), sort_keys=True)
+    return cacheKey(tok.name_or_path, getattr(tok, "chat_template", None), hashlib.sha256(body.encode("utf-8")).hexdigest())
+
+def packTokenized(ds, tok, maxSeqLen: int):
+    """Chat-template + tokenize, then concatenate with EOS and cut into maxSeqLen blocks (as TRL packing does)."""
+    def _tokenize(batch):
+        texts = [tok.apply_chat_template(chatTemplateRoles(m), tokenize=False) for m in batch["messages"]]
+        return {"ids": tok(texts, add_special_tokens=False)["input_ids"]}
+
+    def _pack(batch):
+        flat = []
+        for ids in batch["ids"]:
+            flat.extend(ids + [tok.eos_token_id])
+        n = len(flat) // maxSeqLen * maxSeqLen   # the ragged tail of each map batch is dropped
+        blocks = [flat[i:i + maxSeqLen] for i in range(0, n, maxSeqLen)]
+        return {"input_ids": blocks, "attention_mask": [[1] * maxSeqLen for _ in blocks]}
+
+    tokenized = ds.map(_tokenize, batched=True, remove_columns=ds.column_names)
+    packed = tokenized.map(_pack, batched=True, batch_size=1000, remove_columns=["ids"])
+    total = sum(len(ids) + 1 for ids in tokenized["ids"])
+    print(f"[pack] {len(packed)} blocks × {maxSeqLen}: {len(packed) * maxSeqLen / max(total, 1):.1%} of tokens kept, "
+          f"no padding (examples may straddle blocks)")
+    return packed
+
+def encodeWithinBudget(ds, tok, tokenBudget: int):
+    """One row per example, oldest turns trimmed to fit tokenBudget; adds a `length` column for bucketing."""
+    def _encode(ex):
+        msgs, n = trimToTokenBudget(ex["messages"], tok, tokenBudget)
+        if msgs is None:
+            return {"input_ids": [], "attention_mask": [], "length": 0, "trimmed": False}
+        ids = tok.apply_chat_template(chatTemplateRoles(msgs), tokenize=True)
+        return {"input_ids": ids, "attention_mask": [1] * len(ids), "length": len(ids),
+                "trimmed": len(msgs) < len(ex["messages"])}
+
+    enc = ds.map(_encode, remove_columns=ds.column_names)
+    dropped = sum(1 for n in enc["length"] if n == 0)
+    trimmed = sum(1 for t in enc["trimmed"] if t)
+    enc = enc.filter(lambda ex: ex["length"] > 0).remove_columns(["trimmed"])
+    print(f"[budget] {len(enc)} examples ≤ {tokenBudget} tokens "
+          f"({trimmed} had old turns trimmed, {dropped} too long even without history)")
+    return enc
+
+def reportBucketEfficiency(ds, batchSize: int, seed: int = 42) -> Dict:
+    lengths = ds["length"]
+    bucketed = paddingEfficiency(lengths, lengthGroupedBatches(lengths, batchSize, seed))
+    shuffled = list(range(len(lengths)))
+    random.Random(seed).shuffle(shuffled)
+    naive = paddingEfficiency(lengths, [shuffled[i:i + batchSize] for i in range(0, len(shuffled), batchSize)])
+    print(f"[bucket] padding efficiency at batch {batchSize}: {bucketed:.1%} length-grouped vs {naive:.1%} random")
+    return {"batchSize": batchSize, "bucketed": bucketed, "random": naive}
+
+def buildPackedDataset(jsonlPath: str, tok, maxSeqLen: int, seed: int = 42, splitTrain: float = 0.95,
+                       cacheDir: Optional[str] = None, mode: str = "pack"):
+    """
+    Tokenized (train, eval) Arrow datasets, reused across runs when nothing changed.
+    mode="pack": EOS-joined maxSeqLen blocks; mode="bucket": one example per
+    row trimmed to maxSeqLen tokens, with a `length` column for group_by_length.
+    """
+    from datasets import DatasetDict, load_from_disk
+    # "roles": datasets cached before history roles were mapped for the chat template are stale
+    key = cacheKey(mode, "roles", hashFiles([jsonlPath]), tokenizerFingerprint(tok), maxSeqLen, seed, splitTrain)
+    path = os.path.join(cacheDir, mode, key) if cacheDir else None
+    if path and os.path.exists(path):
+        print(f"[cache] {mode} dataset hit: {path}")
+        dd = load_from_disk(path)
+        return dd["train"], dd["test"] if "test" in dd else None
+
+    encode = packTokenized if mode == "pack" else encodeWithinBudget
+    trainDs, evalDs = buildDataset(jsonlPath, seed=seed, splitTrain=splitTrain)
+    trainDs = encode(trainDs, tok, maxSeqLen)
+    evalDs = encode(evalDs, tok, maxSeqLen) if evalDs is not None else None
+    if path:
+        splits = {"train": trainDs}
+        if evalDs is not None:
+            splits["test"] = evalDs
+        DatasetDict(splits).save_to_disk(path)
+        print(f"[cache] {mode} dataset stored: {path}")
+    return trainDs, evalDs
+
 # -------------------------------
 # 4) Device strategy (no BnB)
 # -------------------------------
 import torch
 hasGpu = torch.cuda.is_available()
-print("GPU available:", hasGpu)
 
 # Slightly friendlier defaults if GPU exists (still small models)
 if hasGpu:
@@ -169,9 +205,102 @@ if hasGpu:
     trainBatchPerDev = 2
     gradAccum        = 8
 
+# --------------------------------------------------
+# 4b) Multi-process CPU training (torch DDP, gloo)
+# --------------------------------------------------
+# One fp32 process stops scaling with intra-op threads long before a many-core box
+# runs out of cores; N processes × (cores / N) threads each, gradients all-reduced
+# by DDP over gloo, data sharded by the Trainer's DistributedSampler.
+import torch.distributed as dist
+from contextlib import contextmanager
+
+def distInfo():
+    """(rank, worldSize) from the torch.distributed.run environment; (0, 1) otherwise."""
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+def launchCpuDdp(nproc: int, script: str, scriptArgs: Optional[List[str]] = None) -> int:
+    """Re-run `script` under torch.distributed.run with nproc local CPU workers."""
+    threads = max(1, (os.cpu_count() or 1) // nproc)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), CUDA_VISIBLE_DEVICES="")
+    cmd = [sys.executable, "-m", "torch.distributed.run", "--standalone",
+           f"--nproc_per_node={nproc}", script] + list(scriptArgs or [])
+    return subprocess.call(cmd, env=env)
+
+def initCpuDdp() -> int:
+    """Join the gloo process group (before the Trainer, so data prep can use barriers)."""
+    rank, worldSize = distInfo()
+    if worldSize > 1 and not dist.is_initialized():
+        dist.init_process_group(backend="gloo")
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // worldSize))
+        print(f"[ddp] rank {rank}/{worldSize}, {torch.get_num_threads()} threads")
+    return worldSize
+
+def perRankGradAccum(gradAccum: int, worldSize: int) -> int:
+    """Per-rank accumulation that keeps trainBatchPerDev × gradAccum as the effective batch."""
+    if gradAccum % worldSize:
+        raise ValueError(f"gradAccum={gradAccum} is not divisible by {worldSize} processes; the effective "
+                         f"batch would change. Pick a process count that divides it, or adjust gradAccum.")
+    return gradAccum // worldSize
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+def broadcastFromRank0(obj):
+    """Every rank gets rank 0's value (keeps per-rank decisions in lockstep)."""
+    if not dist.is_initialized():
+        return obj
+    box = [obj]
+    dist.broadcast_object_list(box, src=0)
+    return box[0]
+
+@contextmanager
+def rankZeroFirst():
+    """Rank 0 runs the block first (fills on-disk caches); the others follow and hit them."""
+    rank, _ = distInfo()
+    if rank != 0:
+        barrier()
+    yield
+    if rank == 0:
+        barrier()
+
 # ------------------------------------
 # 5) Training (LoRA + TRL SFTTrainer)
 # ------------------------------------
+def estimateParamCount(cfg) -> int:
+    # Decoder-only transformer (Qwen2/Llama layout) from config.json alone
+    h, L, inter, V = cfg.hidden_size, cfg.num_hidden_layers, cfg.intermediate_size, cfg.vocab_size
+    heads = cfg.num_attention_heads
+    kvHeads = getattr(cfg, "num_key_value_heads", None) or heads
+    headDim = h // heads
+    attn = 2 * h * h + 2 * h * kvHeads * headDim + h + 2 * kvHeads * headDim   # q/o + k/v (+ qkv biases)
+    mlp = 3 * h * inter                                                          # gate/up/down
+    norms = 2 * h
+    embed = V * h
+    lmHead = 0 if getattr(cfg, "tie_word_embeddings", False) else V * h
+    return L * (attn + mlp + norms) + embed + lmHead + h
+
+def availableMemoryBytes() -> int:
+    if hasGpu:
+        free, _ = torch.cuda.mem_get_info()
+        return free
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+def probeBaseModel(modelName: str, headroom: float = 1.6, copies: int = 1) -> Dict:
+    """Config-only check (no weights downloaded or materialized) of whether modelName fits.
+    `copies`: resident replicas (one per DDP process)."""
+    from transformers import AutoConfig
+    cfg = AutoConfig.from_pretrained(modelName, trust_remote_code=True)
+    params = estimateParamCount(cfg)
+    bytesPerParam = 2 if hasGpu else 4   # fp16 on GPU, fp32 on CPU (see tryLoadBaseModel)
+    need = int(params * bytesPerParam * headroom * copies)
+    avail = availableMemoryBytes()
+    return {"name": modelName, "params": params, "needBytes": need, "availBytes": avail, "fits": need <= avail}
+
 def tryLoadBaseModel(modelName: str):
     from transformers import AutoModelForCausalLM
     if hasGpu:
@@ -193,6 +322,184 @@ def tryLoadBaseModel(modelName: str):
             low_cpu_mem_usage=True,
         )
 
+def currentRssBytes() -> int:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+class PeakMemory:
+    """Peak CUDA allocation (GPU) or sampled peak RSS (CPU) over a `with` block, in bytes."""
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, currentRssBytes())
+
+    def __enter__(self):
+        import threading
+        if hasGpu:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            self.peak = currentRssBytes()
+            self._done = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if hasGpu:
+            torch.cuda.synchronize()
+            self.peak = torch.cuda.max_memory_allocated()
+        else:
+            self._done.set()
+            self._thread.join()
+            self.peak = max(self.peak, currentRssBytes())
+        return False
+
+def isAllocationFailure(e: BaseException) -> bool:
+    """CUDA OOM ("CUDA out of memory") or a failed CPU allocation
+    ("DefaultCPUAllocator: can't allocate memory: you tried to allocate ...")."""
+    msg = str(e).lower()
+    return "out of memory" in msg or "can't allocate memory" in msg
+
+def calibrateBatchConfig(
+    model,
+    vocabSize: int,
+    effectiveBatch: int,
+    seqLens: List[int],
+    batchSizes: List[int],
+    steps: int = 3,
+    memFraction: float = 0.9,
+    outDir: Optional[str] = None
+) -> Optional[Dict]:
+    """Time a few forward/backward steps per (seqLen, batch) on random tokens and pick the
+    highest tokens/sec config whose peak memory fits. Weights are untouched (no optimizer step).
+    Returns {"trainBatchPerDev", "gradAccum", "maxSeqLen"} or None if nothing fits."""
+    device = next(model.parameters()).device
+    # Budget = what training may hold at peak: already-resident usage + a slice of what is free
+    resident = torch.cuda.memory_allocated() if hasGpu else currentRssBytes()
+    budget = resident + int(availableMemoryBytes() * memFraction)
+    model.train()
+
+    def step(ids):
+        loss = model(input_ids=ids, labels=ids).loss
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    results = []
+    for seqLen in sorted(set(seqLens)):
+        for bs in sorted(set(batchSizes)):
+            if effectiveBatch % bs:
+                continue
+            ids = torch.randint(0, vocabSize, (bs, seqLen), device=device)
+            row = {"maxSeqLen": seqLen, "trainBatchPerDev": bs, "gradAccum": effectiveBatch // bs}
+            try:
+                with PeakMemory() as mem:
+                    step(ids)   # warm-up (allocator, kernels)
+                    t0 = time.perf_counter()
+                    for _ in range(steps):
+                        step(ids)
+                    if hasGpu:
+                        torch.cuda.synchronize()
+                    dt = time.perf_counter() - t0
+            except RuntimeError as e:   # torch.cuda.OutOfMemoryError subclasses RuntimeError
+                if not isAllocationFailure(e):
+                    raise
+                model.zero_grad(set_to_none=True)
+                if hasGpu:
+                    torch.cuda.empty_cache()
+                results.append({**row, "fits": False, "error": "oom"})
+                print(f"[calib] seq={seqLen} batch={bs}: out of memory")
+                break
+            row.update({
+                "tokensPerSec": round(bs * seqLen * steps / dt, 1),
+                "stepSeconds": round(dt / steps, 3),
+                "peakMemBytes": mem.peak,
+                "fits": mem.peak <= budget,
+            })
+            results.append(row)
+            print(f"[calib] seq={seqLen} batch={bs}: {row['tokensPerSec']} tok/s, "
+                  f"peak {mem.peak / 1024 ** 3:.2f} GiB{'' if row['fits'] else ' (over budget)'}")
+            if not row["fits"]:
+                break   # larger batches at this length only need more
+        if hasGpu:
+            torch.cuda.empty_cache()
+
+    fitting = [r for r in results if r["fits"]]
+    chosen = None
+    if fitting:
+        best = max(fitting, key=lambda r: r["tokensPerSec"])
+        chosen = {k: best[k] for k in ("trainBatchPerDev", "gradAccum", "maxSeqLen")}
+    if outDir:
+        os.makedirs(outDir, exist_ok=True)
+        with open(os.path.join(outDir, "calibration.json"), "w", encoding="utf-8") as w:
+            json.dump({
+                "device": torch.cuda.get_device_name(0) if hasGpu else "cpu",
+                "effectiveBatch": effectiveBatch,
+                "memBudgetBytes": budget,
+                "chosen": chosen,
+                "results": results,
+            }, w, ensure_ascii=False, indent=2)
+    return chosen
+
+def runFingerprint(dataKey: str, baseModel: str, **hyper) -> str:
+    """Identity of a training run: checkpoints only resume into a run with the same key."""
+    return cacheKey("run", dataKey, baseModel, hyper)
+
+# Checkpoints of other runs (other data, base model or hyperparameters) are never deleted:
+# they are moved to <outDir>/previous-runs/<runKey>/ and found there again when a later
+# run has the same key (e.g. settings changed and then changed back).
+def previousRunsDir(outDir: str, runKey: Optional[str]) -> str:
+    return os.path.join(outDir, "previous-runs", runKey or "untagged")
+
+def latestCheckpoint(outDir: str, runKey: Optional[str] = None) -> Optional[str]:
+    """Newest checkpoint-* in outDir; with runKey, the newest one written by a run with that key
+    (in outDir or set aside under previous-runs/)."""
+    from train_callbacks import checkpointRunKey, listCheckpoints
+    if runKey is None:
+        found = listCheckpoints(outDir)
+    else:
+        found = [(step, p) for parent in (outDir, previousRunsDir(outDir, runKey))
+                 for step, p in listCheckpoints(parent) if checkpointRunKey(p) == runKey]
+        others = [p for _, p in listCheckpoints(outDir) if checkpointRunKey(p) != runKey]
+        if others and not found:
+            print(f"[ckpt] {len(others)} checkpoint(s) in {outDir} belong to a different run "
+                  f"(data, base model or hyperparameters changed); not resuming them")
+    return max(found)[1] if found else None
+
+def setAsideCheckpoints(outDir: str, keepRunKey: Optional[str] = None):
+    """Move checkpoint-* dirs not written by keepRunKey to previous-runs/<their key>/, so a new
+    run's saves and pruning never touch them."""
+    import shutil
+    from train_callbacks import checkpointRunKey, listCheckpoints
+    for _, path in listCheckpoints(outDir):
+        key = checkpointRunKey(path)
+        if keepRunKey is not None and key == keepRunKey:
+            continue
+        dest = os.path.join(previousRunsDir(outDir, key), os.path.basename(path))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.rmtree(dest, ignore_errors=True)   # an older copy of the same run's same step
+        os.replace(path, dest)
+        print(f"[ckpt] set aside {path} → {dest}")
+
+def clearCheckpoints(outDir: str, runKey: Optional[str]):
+    """Remove this run's checkpoints (and stray temp dirs) once its adapter is saved."""
+    import shutil
+    from train_callbacks import checkpointRunKey, listCheckpoints
+    for parent in (outDir, previousRunsDir(outDir, runKey)):
+        for _, path in listCheckpoints(parent):
+            if checkpointRunKey(path) == runKey:
+                shutil.rmtree(path, ignore_errors=True)
+    for d in os.listdir(outDir) if os.path.isdir(outDir) else []:
+        if d.startswith(".tmp-checkpoint-"):
+            shutil.rmtree(os.path.join(outDir, d), ignore_errors=True)
+
 def trainLoraSft(
     baseModel: str,
     trainJsonl: str,
@@ -207,19 +514,33 @@ def trainLoraSft(
     loraDropout: float,
     saveSteps: int,
     loggingSteps: int,
-    seed: int
-):
+    seed: int,
+    cacheDir: Optional[str] = None,
+    model=None,
+    batchMode: str = "pack",
+    tokenBudget: Optional[int] = None,
+    autoTune: bool = False,
+    maxSteps: int = -1,
+    saveMinutes: Optional[float] = None,
+    saveKeep: int = 2,
+    resumeFrom: Optional[str] = None,
+    runKey: Optional[str] = None,
+    metricsFile: Optional[str] = "train_metrics.jsonl",
+    profileSteps=None
+) -> Dict:
     from transformers import AutoTokenizer
-    from trl import SFTTrainer, SFTConfig
-    from peft import LoraConfig
+    from trl import SFTConfig
+    from peft import LoraConfig, PeftModel, get_peft_model
+    from train_callbacks import AsyncAdapterCheckpoint, ThroughputMetrics, TimedSFTTrainer
 
     print("Loading tokenizer…")
     tok = AutoTokenizer.from_pretrained(baseModel, use_fast=True, trust_remote_code=True, padding_side="left")
     if tok.pad_token is None:
         tok.pad_token = tok.eos_token
 
-    print("Loading base model… (no bitsandbytes)")
-    model = tryLoadBaseModel(baseModel)
+    if model is None:
+        print("Loading base model… (no bitsandbytes)")
+        model = tryLoadBaseModel(baseModel)
 
     # Memory safety knobs
     try:
@@ -227,9 +548,6 @@ def trainLoraSft(
     except Exception:
         pass
 
-    print("Building dataset…")
-    trainDs, evalDs = buildDataset(trainJsonl, seed=seed, splitTrain=0.95)
-
     # Target modules set robustly for Qwen; non-existent names are ignored
     targetMods = ["q_proj","k_proj","v_proj","o_proj","up_proj","down_proj","gate_proj"]
     loraCfg = LoraConfig(
@@ -241,42 +559,107 @@ def trainLoraSft(
         task_type="CAUSAL_LM",
     )
 
+    _, worldSize = distInfo()
+    if worldSize > 1:
+        # Keep the effective batch constant: each rank contributes trainBatchPerDev per micro-step
+        gradAccum = perRankGradAccum(gradAccum, worldSize)
+        print(f"[ddp] effective batch {trainBatchPerDev} × accum {gradAccum} × {worldSize} ranks"
+              f" = {trainBatchPerDev * gradAccum * worldSize}")
+        if autoTune:
+            print("[calib] skipped under DDP (per-rank memory is shared); using the defaults")
+            autoTune = False
+
+    chosen = None
+    calibPath = os.path.join(outDir, "calibration.json")
+    if autoTune and resumeFrom and os.path.exists(calibPath):
+        # A resumed run must keep the batch layout its trainer_state was written with
+        with open(calibPath, "r", encoding="utf-8") as f:
+            chosen = json.load(f)["chosen"]
+        print(f"[calib] resuming with the recorded config: {chosen}")
+    elif autoTune:
+        # Calibrate on the LoRA-wrapped model (what training actually runs); the same
+        # wrapped model is handed to SFTTrainer, so the adapter is injected only once.
+        model = get_peft_model(model, loraCfg)
+        if getattr(model, "is_gradient_checkpointing", False):
+            model.enable_input_require_grads()   # LoRA grads flow through checkpointed blocks
+        seqLens = [tokenBudget or maxSeqLen] if batchMode == "bucket" else calibSeqLens
+        print("Calibrating batch size / grad accumulation / seq length…")
+        chosen = calibrateBatchConfig(model, len(tok), trainBatchPerDev * gradAccum, seqLens,
+                                      calibBatchSizes, steps=calibSteps, outDir=outDir)
+        if not chosen:
+            print("[calib] no calibrated config fits; keeping the defaults")
+    if chosen:
+        trainBatchPerDev, gradAccum = chosen["trainBatchPerDev"], chosen["gradAccum"]
+        if batchMode == "bucket":
+            tokenBudget = chosen["maxSeqLen"]
+        else:
+            maxSeqLen = chosen["maxSeqLen"]
+        print(f"[calib] using batch={trainBatchPerDev} × accum={gradAccum}, seq={chosen['maxSeqLen']}")
+
+    print("Building dataset…")
+    # Tokenize once; later runs with the same data/tokenizer/length load the Arrow cache
+    with rankZeroFirst():
+        if batchMode == "bucket":
+            budget = tokenBudget or maxSeqLen
+            trainDs, evalDs = buildPackedDataset(trainJsonl, tok, budget, seed=seed, splitTrain=0.95,
+                                                 cacheDir=cacheDir, mode="bucket")
+            reportBucketEfficiency(trainDs, trainBatchPerDev, seed=seed)
+        else:
+            trainDs, evalDs = buildPackedDataset(trainJsonl, tok, maxSeqLen, seed=seed, splitTrain=0.95, cacheDir=cacheDir)
+
     bf16_ok = torch.cuda.is_bf16_supported() if hasGpu else False
     trainCfg = SFTConfig(
         output_dir=outDir,
         num_train_epochs=epochs,
+        max_steps=maxSteps,
         per_device_train_batch_size=trainBatchPerDev,
         gradient_accumulation_steps=gradAccum,
         learning_rate=lr,
         logging_steps=loggingSteps,
-        save_steps=saveSteps,
-        save_total_limit=2,
+        save_strategy="no",      # full-state saves replaced by AsyncAdapterCheckpoint below
         optim="adamw_torch",     # no paged_adamw (bnb-free)
         bf16=bf16_ok,            # only if GPU supports bf16
         fp16=hasGpu and not bf16_ok,  # fp16 on GPU if bf16 not available
         max_seq_length=maxSeqLen,
-        packing=True,
+        packing=False,           # already packed / budgeted by buildPackedDataset
+        dataset_kwargs={"skip_prepare_dataset": True},
+        group_by_length=batchMode == "bucket",   # LengthGroupedSampler over the `length` column
+        length_column_name="length",
         seed=seed,
+        ddp_backend="gloo" if worldSize > 1 else None,
+        ddp_find_unused_parameters=False,   # every LoRA weight gets a gradient each step
         report_to=[]
     )
 
     print("Starting SFT…")
-    trainer = SFTTrainer(
+    trainer = TimedSFTTrainer(
         model=model,
         tokenizer=tok,
         train_dataset=trainDs,
         eval_dataset=evalDs,
-        peft_config=loraCfg,
+        peft_config=None if isinstance(model, PeftModel) else loraCfg,
         args=trainCfg,
         formatting_func=None,
+        metrics=ThroughputMetrics(outDir, metricsFile, profileSteps) if metricsFile else None,
     )
-    trainer.train()
-
-    print("Saving LoRA adapter + tokenizer…")
-    os.makedirs(outDir, exist_ok=True)
-    trainer.model.save_pretrained(outDir)
-    tok.save_pretrained(outDir)
-    print(f"Saved to: {outDir}")
+    trainer.add_callback(AsyncAdapterCheckpoint(outDir, everySteps=saveSteps,
+                                                everySeconds=saveMinutes * 60 if saveMinutes else None,
+                                                keep=saveKeep, runKey=runKey))
+    if resumeFrom:
+        print(f"Resuming from {resumeFrom}")
+    result = trainer.train(resume_from_checkpoint=resumeFrom)
+
+    # DDP replicas hold identical adapters after the all-reduce: rank 0 writes the one copy
+    if trainer.is_world_process_zero():
+        print("Saving LoRA adapter + tokenizer…")
+        os.makedirs(outDir, exist_ok=True)
+        trainer.model.save_pretrained(outDir)
+        tok.save_pretrained(outDir)
+        # The run is complete: its checkpoints must not be resumed by the next main()
+        clearCheckpoints(outDir, runKey)
+        print(f"Saved to: {outDir}")
+    return {**result.metrics, "world_size": worldSize, "per_device_batch": trainBatchPerDev,
+            "grad_accum": gradAccum, "max_seq_len": maxSeqLen}
 
 # -------------------------------
 # 6) Inference sanity utilities
@@ -294,80 +677,63 @@ def detectBaseFromAdapter(adapterDir: str) -> str:
             pass
     return candidateBaseModels[0]
 
-def generateNextQuestion(adapterDir: str, promptHistory: List[Dict], maxNewTokens: int = 32) -> str:
-    from transformers import AutoModelForCausalLM, AutoTokenizer
-    from peft import PeftModel
-
-    baseModel = detectBaseFromAdapter(adapterDir)
-    tok = AutoTokenizer.from_pretrained(baseModel, use_fast=True, trust_remote_code=True)
-    if tok.pad_token is None:
-        tok.pad_token = tok.eos_token
-
-    # Load base (no quantization libs)
-    if hasGpu:
-        base = AutoModelForCausalLM.from_pretrained(
-            baseModel, torch_dtype=torch.float16, device_map="auto", trust_remote_code=True
-        )
-    else:
-        base = AutoModelForCausalLM.from_pretrained(
-            baseModel, torch_dtype=torch.float32, device_map={"": "cpu"}, trust_remote_code=True
-        )
-    model = PeftModel.from_pretrained(base, adapterDir)
-    model.eval()
-
-    sysMsg = (
-        "You are a clinical assistant. Output ONLY the next, single best follow-up question to the patient. "
-        "Keep it concise (max 20 words). Do not provide diagnoses, reassurance, or instructions; ask a question. "
-        "End the sentence with a question mark."
-    )
-    messages = [{"role": "system", "content": sysMsg}] + promptHistory
-
-    if hasattr(tok, "apply_chat_template"):
-        inputText = tok.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    else:
-        inputText = "\n".join([f"{m['role'].upper()}: {m['content']}" for m in messages]) + "\nASSISTANT: "
-
-    inputs = tok([inputText], return_tensors="pt")
-    if hasGpu:
-        inputs = {k: v.cuda() for k, v in inputs.items()}
-
-    with torch.no_grad():
-        out = model.generate(
-            **inputs,
-            max_new_tokens=maxNewTokens,
-            do_sample=True,
-            temperature=0.7,
-            top_p=0.9,
-            eos_token_id=tok.eos_token_id
-        )
-    gen = tok.decode(out[0], skip_special_tokens=True)
-    if "ASSISTANT:" in gen:
-        gen = gen.split("ASSISTANT:")[-1].strip()
-    return gen.split("\n")[0].strip()
+def generateNextQuestion(adapterDir: str, promptHistory: List[Dict], maxNewTokens: int = 32,
+                         draftModel: Optional[str] = None, draftAdapterDir: Optional[str] = None) -> str:
+    # Base + adapter are loaded once per adapterDir and stay resident
+    # (see followup.get_engine); repeat calls only pay for generation.
+    # With a draftModel the small model proposes tokens and the trained one verifies them.
+    from followup import get_engine
+    engine = get_engine(adapterDir, draft_model=draftModel, draft_adapter_dir=draftAdapterDir)
+    return engine.generate(promptHistory, max_new_tokens=maxNewTokens, temperature=0.7, top_p=0.9)
 
 # -------------------------------
 # 7) End-to-end runner
 # -------------------------------
 def main():
-    # 1) Build JSONL from CSV
+    if cpuProcs > 1 and not hasGpu and distInfo()[1] == 1:
+        perRankGradAccum(gradAccum, cpuProcs)   # fail before spawning anything
+        print(f"Launching {cpuProcs} CPU processes (torch DDP, gloo)…")
+        sys.exit(launchCpuDdp(cpuProcs, os.path.abspath(__file__)))
+    worldSize = initCpuDdp()
+    rank, _ = distInfo()
+    print("GPU available:", hasGpu)
+
+    # 1) Build JSONL from CSV (rank 0 only; the other ranks wait for the file)
     print(f"Loading CSV from: {dataPath}")
-    byId = loadConvosFromCsv(dataPath)
-    pairs = buildSftPairs(byId)
-    jsonlPath = os.path.join(outputDir, "train.jsonl")
     os.makedirs(outputDir, exist_ok=True)
-    saveJsonl(pairs, jsonlPath)
-    print(f"Prepared {len(pairs)} SFT messages → {jsonlPath}")
-
-    # 2) Pick the first base model that loads cleanly
+    dataFiles = sorted(glob.glob(dataPath)) if any(c in dataPath for c in "*?[") else [dataPath]
+    if not dataFiles:
+        raise FileNotFoundError(f"No CSV/TSV files match {dataPath}")
+    jsonlPath = os.path.join(outputDir, "train.jsonl")
+    # keyed on the CSV bytes + pair-building params: unchanged data is never re-prepared
+    dataKey = cacheKey("sft", "dedup", hashFiles(dataFiles), pairParams, sftSysMsg)
+    if cacheDir:
+        jsonlPath = os.path.join(cacheDir, "jsonl", f"sft-{dataKey}.jsonl")
+    if rank == 0:
+        if cacheDir and os.path.exists(jsonlPath):
+            print(f"[cache] SFT JSONL hit: {jsonlPath}")
+        else:
+            if len(dataFiles) > 1 or dataFiles[0] != dataPath:
+                nPairs = prepareManyCsv(dataFiles, jsonlPath, assumeSorted=csvSortedById, **pairParams)["pairs"]
+            else:
+                nPairs = prepareSftJsonl(dataPath, jsonlPath, assumeSorted=csvSortedById, **pairParams)
+            print(f"Prepared {nPairs} SFT messages → {jsonlPath}")
+    barrier()
+
+    # 2) Pick the first base model that fits (config-only probe), load it ONCE
     baseModel = None
+    model = None
     lastErr = None
     for name in candidateBaseModels:
         try:
-            print(f"Probing base model: {name}")
-            _ = tryLoadBaseModel(name)   # load + free immediately
-            del _
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+            probe = probeBaseModel(name, headroom=memHeadroom, copies=worldSize)
+            gib = 1024 ** 3
+            print(f"Probing base model: {name} ~{probe['params'] / 1e9:.2f}B params, "
+                  f"needs ~{probe['needBytes'] / gib:.1f} GiB, free {probe['availBytes'] / gib:.1f} GiB")
+            if not broadcastFromRank0(probe["fits"]):   # all ranks pick the same model
+                lastErr = MemoryError(f"{name} needs ~{probe['needBytes'] / gib:.1f} GiB")
+                continue
+            model = tryLoadBaseModel(name)   # handed straight to training below
             baseModel = name
             print(f"Using base model: {baseModel}")
             break
@@ -378,7 +744,17 @@ def main():
     if baseModel is None:
         raise RuntimeError(f"Could not load any base model. Last error: {lastErr}")
 
-    # 3) Train LoRA SFT
+    # 3) Train LoRA SFT (resume only a checkpoint of this exact data/model/hyperparameter run)
+    runKey = runFingerprint(dataKey, baseModel, lr=lr, loraR=loraR, loraAlpha=loraAlpha, loraDropout=loraDropout,
+                            epochs=epochs, seed=seed, maxSeqLen=maxSeqLen, trainBatchPerDev=trainBatchPerDev,
+                            gradAccum=gradAccum, worldSize=worldSize, batchMode=batchMode,
+                            tokenBudget=tokenBudget, autoTune=autoTuneBatch)
+    resumeFrom = None
+    if rank == 0:
+        resumeFrom = latestCheckpoint(outputDir, runKey) if resumeTraining else None
+        # everything this run will not continue from is moved aside, not deleted
+        setAsideCheckpoints(outputDir, keepRunKey=runKey if resumeFrom else None)
+    resumeFrom = broadcastFromRank0(resumeFrom)
     trainLoraSft(
         baseModel=baseModel,
         trainJsonl=jsonlPath,
@@ -393,21 +769,48 @@ def main():
         loraDropout=loraDropout,
         saveSteps=saveSteps,
         loggingSteps=loggingSteps,
-        seed=seed
+        seed=seed,
+        cacheDir=cacheDir,
+        model=model,
+        saveMinutes=saveMinutes,
+        saveKeep=saveKeep,
+        resumeFrom=resumeFrom,
+        runKey=runKey,
+        metricsFile=metricsFile,
+        profileSteps=profileSteps,
+        batchMode=batchMode,
+        tokenBudget=tokenBudget,
+        autoTune=autoTuneBatch
     )
+    # Drop the trained base+LoRA before merging: merge_adapter loads its own fp32 base and
+    # the sanity check loads the merged export, so keeping this one doubles peak RAM on CPU
+    del model
+    gc.collect()
+    if hasGpu:
+        torch.cuda.empty_cache()
+    if rank != 0:
+        dist.destroy_process_group()
+        return
 
     # 4) Save adapter meta (helps inference auto-detect base)
     writeAdapterMeta(outputDir, baseModel)
 
-    # 5) Tiny sanity gen (optional)
+    # 5) Merge adapter into base weights (inference loads this when present)
+    if mergeAfterTrain:
+        from merge_adapter import merge_adapter
+        merge_adapter(outputDir, base_model=baseModel)
+
+    # 6) Tiny sanity gen (optional)
     try:
         demoHistory = [
             {"role":"patient","content":"I’ve had a dull headache for 3 days and mild fever."}
         ]
         print("Quick sanity check generation:")
-        print("→", generateNextQuestion(outputDir, demoHistory))
+        print("→", generateNextQuestion(outputDir, demoHistory, draftModel=draftModel, draftAdapterDir=draftAdapterDir))
     except Exception as e:
         print("Generation sanity check skipped due to error:", e)
+    if dist.is_initialized():
+        dist.destroy_process_group()
 
 # ---- Run everything ----
 if __name__ == "__main__":